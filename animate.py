@@ -0,0 +1,104 @@
+import  sys, os, json
+import  numpy as np
+import  heatmap
+
+#####################################################################
+#
+#  This script draws the growth of the Kiva world map over time as
+#  a series of heatmap frames, one per time bucket recorded by
+#  process_loans.py (see "Time Buckets" there).
+#
+#  The frames share one set of accumulation buffers: frame t+1 is
+#  drawn by adding only the lender-loans of its bucket to the buffers
+#  of frame t, so drawing every frame costs about as much as drawing
+#  the whole map once (plus coloring each frame). The lender and
+#  loan points of each frame are weighted by their lender-loans.
+#
+#  To execute (from the directory process_loans.py was run in):
+#
+#  python animate.py <frames dir> [cfg]
+#    Writes <frames dir>/<bucket>.png for every bucket, e.g.
+#    frames/2006-04.png, which can be joined into a video with e.g.
+#    ffmpeg -pattern_type glob -i 'frames/*.png' kiva.mp4
+#
+#####################################################################
+
+
+BUCKETS_DIR = 'buckets'
+BUCKET_INDEX_PATH = os.path.join(BUCKETS_DIR, 'index.json')
+EDGE_RECORD_DTYPE = np.dtype([ ('lender_idx', '<i4'), ('loan_idx', '<i4'), ('count', '<i4') ])
+
+
+def read_points_by_idx(path):
+    # Returns the lat and lon arrays of the points in the csv file, indexed by idx.
+    chunks = list(heatmap.read_csv_chunks(path, [ 'idx', 'lat', 'lon' ], heatmap.EDGES_PER_CHUNK))
+    idx = np.concatenate([ chunk[0] for chunk in chunks ]).astype(np.int64)
+    lat = np.zeros(idx.max() + 1)
+    lon = np.zeros(idx.max() + 1)
+    lat[idx] = np.concatenate([ chunk[1] for chunk in chunks ])
+    lon[idx] = np.concatenate([ chunk[2] for chunk in chunks ])
+    return lat, lon
+
+
+def read_bucket_index():
+    file = open(BUCKET_INDEX_PATH, 'r')
+    bucket_index = json.loads(file.read())
+    file.close()
+    return bucket_index
+
+
+def read_bucket(bucket, num_records):
+    # Only the records in the index are read; any after them are from an
+    # interrupted execution of process_loans.py.
+    file = open(os.path.join(BUCKETS_DIR, '{0}.bin'.format(bucket)), 'rb')
+    records = np.fromfile(file, dtype=EDGE_RECORD_DTYPE, count=num_records)
+    file.close()
+    return records
+
+
+def add_bucket(hists, lenders, loans, records):
+    edge_hist, lender_hist, loan_hist = hists
+    for start in xrange(0, len(records), heatmap.EDGES_PER_CHUNK):
+        chunk = records[start:start + heatmap.EDGES_PER_CHUNK]
+        lender_lat = lenders[0][chunk['lender_idx']]
+        lender_lon = lenders[1][chunk['lender_idx']]
+        loan_lat = loans[0][chunk['loan_idx']]
+        loan_lon = loans[1][chunk['loan_idx']]
+        counts = chunk['count'].astype(np.float64)
+
+        heatmap.add_arcs(edge_hist, lender_lat, lender_lon, loan_lat, loan_lon, counts)
+        heatmap.add_points(lender_hist, lender_lat, lender_lon, counts)
+        heatmap.add_points(loan_hist, loan_lat, loan_lon, counts)
+
+
+def render_frames(frames_dir, cfg):
+    if not os.path.isdir(frames_dir):
+        os.mkdir(frames_dir)
+
+    lenders = read_points_by_idx('lender_locations.csv')
+    loans = read_points_by_idx('loan_locations.csv')
+    bucket_index = read_bucket_index()
+
+    shape = (cfg['imgHeight'], cfg['imgWidth'])
+    hists = (np.zeros(shape), np.zeros(shape), np.zeros(shape))
+    for bucket in sorted(bucket_index.iterkeys()):
+        bucket_info = bucket_index[bucket]
+        print 'Drawing {0} ({1} lender-loans so far)...'.format(bucket, bucket_info['cumulative_count'])
+        add_bucket(hists, lenders, loans, read_bucket(bucket, bucket_info['num_records']))
+        heatmap.write_png(os.path.join(frames_dir, '{0}.png'.format(bucket)), heatmap.draw_image(cfg, *hists))
+
+    return len(bucket_index)
+
+
+def main(*args):
+    if len(args) < 2:
+        print 'Usage: ' + args[0] + ' <frames dir> [cfg]'
+        return 0
+
+    cfg = heatmap.read_cfg(args[2] if len(args) > 2 else 'custom_cfg.json')
+    num_frames = render_frames(args[1], cfg)
+    print 'Drew {0} frames to {1}.'.format(num_frames, args[1])
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
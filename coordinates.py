@@ -0,0 +1,52 @@
+#####################################################################
+#
+#  This module holds the representation of lat/lon points shared by
+#  process_loans.py and generate_custom_map.py.
+#
+#  Coordinates are fixed-point ints in units of 1e-5 degrees (about
+#  1 meter), which fit in an int32. A point is both coordinates
+#  packed into a single non-negative int, so it's cheap to hash and
+#  compare when used as a map key, and can be stored as a number in
+#  the JSON files. Decimal strings are only parsed when reading the
+#  geocoders' or Kiva's data, and formatted when writing the csv
+#  files.
+#
+#####################################################################
+
+
+COORDINATE_SCALE = 100000
+COORDINATE_OFFSET = 1 << 30
+COORDINATE_MASK = (1 << 32) - 1
+
+
+def to_fixed(degrees):
+    return int(round(float(degrees) * COORDINATE_SCALE))
+
+
+def to_degrees(fixed):
+    return fixed / float(COORDINATE_SCALE)
+
+
+def format_fixed(fixed):
+    return '{0:.5f}'.format(to_degrees(fixed))
+
+
+def pack_point(lat, lon):
+    # The offset keeps points non-negative, so they never collide with the
+    # -1 used to mark invalid locations, and below 2^63, so they stay ints.
+    return ((lat + COORDINATE_OFFSET) << 32) | (lon + COORDINATE_OFFSET)
+
+
+def unpack_point(point):
+    return (point >> 32) - COORDINATE_OFFSET, (point & COORDINATE_MASK) - COORDINATE_OFFSET
+
+
+def parse_point(pair_str):
+    # Parses a "<lat> <lon>" string, e.g. loan['location']['geo']['pairs'].
+    pair_split = pair_str.split()
+    return pack_point(to_fixed(pair_split[0]), to_fixed(pair_split[1]))
+
+
+def point_degrees(point):
+    lat, lon = unpack_point(point)
+    return to_degrees(lat), to_degrees(lon)
@@ -1,5 +1,10 @@
-import  sys, urllib, json, csv, time, subprocess, os, re, traceback
+import  sys, json, csv, time, calendar, subprocess, os, re, traceback, hashlib, heapq, random
 from    math import *
+from    location_normalizer import normalize_location, load_aliases, migrate_locations
+from    geocoders import geocode, NOT_FOUND
+from    rate_control import fetch
+from    log_writer import open_log, close_log, write_record
+from    coordinates import to_fixed, format_fixed, pack_point, unpack_point, parse_point, point_degrees
 
 #####################################################################
 #  
@@ -11,30 +16,82 @@ from    math import *
 #  
 #  To execute:
 #  
-#  python generate_custom_map.py <A> <B>
+#  python generate_custom_map.py <A> <B> [--heatmap] [--preview[=<N>]]
 #    A: Whether to fetch data for a specific lender or an entire 
 #       lending team. L for lender, or T for team
 #    B: The ID of the lender or lending team
+#    --heatmap: Draw the map as a density heatmap (see heatmap.py)
+#       instead of executing the R script
+#    --preview: Quickly draw a preview of the saved map, with a
+#       sample of N lender-loans (see sample_edges), at a lower
+#       resolution
 #  
 #####################################################################
 
 
 # Initialize global constants.
-SECONDS_BETWEEN_KIVA_QUERIES = 1
-SECONDS_BETWEEN_GMAPS_QUERIES = 1
 MAX_EXCEPTIONS_TOLERATED = 5
+SECONDS_BETWEEN_FULL_MEMBER_SWEEPS = 7 * 24 * 60 * 60
+CHECKPOINT_EVERY_LOANS = 50
+CHECKPOINT_EVERY_SECONDS = 5 * 60
+PREVIEW_SAMPLE_SIZE = 2000
+
+# A loan can only be lent to while it's fundraising, which lasts at most this
+# long (with a margin), so a lender can't have lent to a loan more than this
+# long before it was posted.
+MAX_FUNDRAISING_SECONDS = 60 * 24 * 60 * 60
+KIVA_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# The number of distance ranges used to sort the lender-loans (the same as
+# DISTANCE_RANGE_NUM in draw_custom_map.R).
+DISTANCE_RANGE_NUM = 10
+
+# Default page sizes of the Kiva API, used when estimating the number of
+# requests. They are updated from the paging metadata as pages are fetched.
+LENDERS_PER_PAGE = 50
+LOANS_PER_PAGE = 20
 
 
 # [locations] is a map of lender location str to lat/lon point. These are
-# saved locally so we can minimize the number of queries to the Google Maps API.
+# saved locally so we can minimize the number of queries to the geocoders.
 # Invalid locations are also stored (value is -1).
+#
+# All lat/lon points are ints packed by coordinates.py; they are only
+# formatted as decimals when written to the csv files.
 locations = {}
 
+# [processed_loans] is a map of loan id -> the loan's record: its point and
+# a map of the uid -> point of each of its lenders that were added to the
+# map, so that maps can be merged without counting shared loans twice (see
+# merge_custom_maps.py). Loans processed before records were kept map to 1.
 processed_loans = {}
 lender_locations = {}
 loan_locations = {}
 lender_loan_data = {}
 
+# [team_members] is only used for lending teams. It holds a map of
+# member uid -> lat/lon point (-1 if the member's location is invalid),
+# maps of member uid -> loan count and -> member since date (used to plan
+# how the team's loans are fetched), the time of the last full sweep of the
+# team's members, and a map of uid -> lender data of the members whose
+# location couldn't be fetched because of an error (e.g. a network error),
+# to be retried.
+team_members = { 'members': {}, 'loan_counts': {}, 'member_since': {}, 'last_full_sweep': 0, 'retry': {} }
+
+page_sizes = { 'lenders': LENDERS_PER_PAGE, 'loans': LOANS_PER_PAGE }
+
+# [render_state] holds the manifest of the last time the map was drawn, and
+# the lender-loan counts that were drawn (if the saved data is unchanged
+# since then), so that only new lender-loans need to be drawn.
+render_state = { 'manifest': None, 'rendered_edges': None }
+
+# [progress] holds the state of the fetches that are in progress (the next
+# page to fetch and what has been fetched so far), keyed by fetch. It is saved
+# in the checkpoint so an interrupted run can resume where it stopped.
+progress = {}
+
+options = { 'heatmap': False, 'preview': None }
+
 
 #####################################################################
 # 
@@ -49,7 +106,7 @@ def haversine(lat1, lon1, lat2, lon2):
     on the earth (specified in decimal degrees)
     """
     # convert decimal degrees to radians 
-    lon1, lat1, lon2, lat2 = map(radians, [float(lon1), float(lat1), float(lon2), float(lat2)])
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
     # haversine formula 
     dlon = lon2 - lon1 
     dlat = lat2 - lat1 
@@ -65,6 +122,27 @@ def haversine(lat1, lon1, lat2, lon2):
 # 
 #####################################################################
 
+def point_distance(lender_loc, loan_loc):
+    lender_lat, lender_lon = point_degrees(lender_loc)
+    loan_lat, loan_lon = point_degrees(loan_loc)
+    return haversine(lender_lat, lender_lon, loan_lat, loan_lon)
+
+
+def read_point(value):
+    # JSON object keys are always strings, and older versions of this
+    # script saved points as "<lat> <lon>" strings.
+    if isinstance(value, basestring) and ' ' in value.strip():
+        return parse_point(value)
+    return int(value)
+
+
+def read_points(points):
+    result = {}
+    for point, value in points.iteritems():
+        result[read_point(point)] = value
+    return result
+
+
 def create_dirs():
     for dir in [ 'data', 'images' ]:
         try:
@@ -73,14 +151,10 @@ def create_dirs():
             continue
 
 
-def log_exception(data_str, data = ''):
+def log_exception(data_str, data = '', category = 'error'):
     log_exception.num_errors_logged += 1
     
-    log_exception.log_file.write('-----------------------------------------------------------\n')
-    log_exception.log_file.write('Unexpected error processing {0}:\n{1}\n'.format(data_str, data))
-    log_exception.log_file.write('-----------------------------------------------------------\n')
-    traceback.print_exc(None, log_exception.log_file)
-    log_exception.log_file.write('-----------------------------------------------------------\n\n')
+    write_record('error', category, u'Unexpected error processing {0}'.format(data_str), data, traceback.format_exc())
     
     if(log_exception.num_errors_logged > MAX_EXCEPTIONS_TOLERATED):
         # Abort the program if the number of errors is too high.
@@ -88,15 +162,23 @@ def log_exception(data_str, data = ''):
         sys.exit()
 
 
-def log_warning(warning, data = ''):
+def log_warning(warning, data = '', category = 'warning'):
     log_warning.num_warnings_logged += 1
     
-    log_exception.log_file.write('-----------------------------------------------------------\n')
-    try:
-        log_exception.log_file.write(u'Warning: {0}\n{1}\n'.format(warning, data))
-    except UnicodeEncodeError:
-        log_exception.log_file.write(u'Exception when trying to display warning: {0}\n'.format(data))
-    log_exception.log_file.write('-----------------------------------------------------------\n\n')
+    write_record('warning', category, warning, data)
+
+
+def open_for_replace(path):
+    return open(path + '.tmp', 'wb')
+
+
+def finish_replace(file, path):
+    # The file is written next to its destination and then renamed over
+    # it, so a crash never leaves a partially written file behind.
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+    os.rename(path + '.tmp', path)
 
 
 def unicode_csv_reader(utf8_data):
@@ -110,7 +192,10 @@ def read_data(id):
     try:
         file = open('data/saved_locations.json', 'r')
         global locations
-        locations = json.loads(file.read())
+        locations = migrate_locations(json.loads(file.read()))
+        for lender_loc, location in locations.iteritems():
+            if location != -1:
+                locations[lender_loc] = read_point(location)
         file.close()
     except IOError:
         pass
@@ -134,7 +219,8 @@ def read_data(id):
         reader = unicode_csv_reader(file)
         reader.next()
         for row in reader:
-            lender_locations['{0} {1}'.format(row[0], row[1])] = int(row[2])
+            lender_loc = pack_point(to_fixed(row[0]), to_fixed(row[1]))
+            lender_locations[lender_loc] = lender_locations.get(lender_loc, 0) + int(row[2])
         file.close()
     except IOError:
         # File doesn't exist.
@@ -148,7 +234,8 @@ def read_data(id):
         reader = unicode_csv_reader(file)
         reader.next()
         for row in reader:
-            loan_locations['{0} {1}'.format(row[0], row[1])] = int(row[2])
+            loan_loc = pack_point(to_fixed(row[0]), to_fixed(row[1]))
+            loan_locations[loan_loc] = loan_locations.get(loan_loc, 0) + int(row[2])
         file.close()
     except IOError:
         # File doesn't exist.
@@ -162,69 +249,181 @@ def read_data(id):
         reader = unicode_csv_reader(file)
         reader.next()
         for row in reader:
-            lender_loc = '{0} {1}'.format(row[0], row[1])
+            lender_loc = pack_point(to_fixed(row[0]), to_fixed(row[1]))
             if lender_loc not in lender_loan_data:
                 lender_loan_data[lender_loc] = {}
-            loan_loc = '{0} {1}'.format(row[2], row[3])
+            loan_loc = pack_point(to_fixed(row[2]), to_fixed(row[3]))
             
-            lender_loan_data[lender_loc][loan_loc] = {
-                'count': int(row[5]),
-                'distance': row[4]
-            }
+            if loan_loc not in lender_loan_data[lender_loc]:
+                lender_loan_data[lender_loc][loan_loc] = {
+                    'count': int(row[5]),
+                    'distance': float(row[4])
+                }
+            else:
+                lender_loan_data[lender_loc][loan_loc]['count'] += int(row[5])
         file.close()
     except IOError:
         # File doesn't exist.
         pass
     except:
         log_exception('{0}_lender_loans.csv'.format(id))
+    
+    # Read in the team members.
+    try:
+        file = open('data/{0}_members.json'.format(id))
+        global team_members
+        team_members = json.loads(file.read())
+        for uid, lender_loc in team_members['members'].iteritems():
+            if lender_loc != -1:
+                team_members['members'][uid] = read_point(lender_loc)
+        file.close()
+    except IOError:
+        pass
+    except:
+        log_exception('{0}_members.json'.format(id))
+    
+    read_render_manifest(id)
+    read_checkpoint(id)
 
 
 def write_data(id):
     # Write the saved locations.
-    file = open('data/saved_locations.json', 'wb')
-    file.write(json.dumps(locations))
-    file.close()
+    write_saved_locations()
     
     # Write the processed loans.
-    file = open('data/{0}_processed_loans.json'.format(id), 'wb')
+    path = 'data/{0}_processed_loans.json'.format(id)
+    file = open_for_replace(path)
     file.write(json.dumps(processed_loans))
-    file.close()
+    finish_replace(file, path)
     
     # Write the lender locations.
-    file = open('data/{0}_lenders.csv'.format(id), 'wb')
+    path = 'data/{0}_lenders.csv'.format(id)
+    file = open_for_replace(path)
     writer = csv.writer(file, delimiter=';')
     writer.writerow([ 'lat', 'lon', 'count' ])
-    for lender_loc, count in lender_locations.iteritems():
-        lender_loc_split = lender_loc.partition(' ')
-        writer.writerow([ lender_loc_split[0], lender_loc_split[2], count ])
-    file.close()
+    for lender_loc, count in sorted(lender_locations.iteritems()):
+        lat, lon = unpack_point(lender_loc)
+        writer.writerow([ format_fixed(lat), format_fixed(lon), count ])
+    finish_replace(file, path)
     
     # Write the loan locations.
-    file = open('data/{0}_loans.csv'.format(id), 'wb')
+    path = 'data/{0}_loans.csv'.format(id)
+    file = open_for_replace(path)
     writer = csv.writer(file, delimiter=';')
     writer.writerow([ 'lat', 'lon', 'count' ])
-    for loan_loc, count in loan_locations.iteritems():
-        loan_loc_split = loan_loc.partition(' ')
-        writer.writerow([ loan_loc_split[0], loan_loc_split[2], count ])
-    file.close()
+    for loan_loc, count in sorted(loan_locations.iteritems()):
+        lat, lon = unpack_point(loan_loc)
+        writer.writerow([ format_fixed(lat), format_fixed(lon), count ])
+    finish_replace(file, path)
     
     # Write the lender-loan data.
-    file = open('data/{0}_lender_loans.csv'.format(id), 'wb')
+    path = 'data/{0}_lender_loans.csv'.format(id)
+    file = open_for_replace(path)
     writer = csv.writer(file, delimiter=';')
     writer.writerow(['lender_lat', 'lender_lon', 'loan_lat', 'loan_lon', 'distance', 'count'])
-    for lender_loc, loan_locs in lender_loan_data.iteritems():
-        lender_loc_split = lender_loc.partition(' ')
-        for loan_loc, lender_loan_obj in loan_locs.iteritems():
-            loan_loc_split = loan_loc.partition(' ')
+    for lender_loc, loan_locs in sorted(lender_loan_data.iteritems()):
+        lender_lat, lender_lon = unpack_point(lender_loc)
+        for loan_loc, lender_loan_obj in sorted(loan_locs.iteritems()):
+            loan_lat, loan_lon = unpack_point(loan_loc)
             writer.writerow([
-                lender_loc_split[0],
-                lender_loc_split[2],
-                loan_loc_split[0],
-                loan_loc_split[2],
+                format_fixed(lender_lat),
+                format_fixed(lender_lon),
+                format_fixed(loan_lat),
+                format_fixed(loan_lon),
                 lender_loan_obj['distance'],
                 lender_loan_obj['count']
             ])
-    file.close()
+    finish_replace(file, path)
+    
+    # Write the team members.
+    if len(team_members['members']) > 0:
+        path = 'data/{0}_members.json'.format(id)
+        file = open_for_replace(path)
+        file.write(json.dumps(team_members))
+        finish_replace(file, path)
+
+
+def write_saved_locations():
+    path = 'data/saved_locations.json'
+    file = open_for_replace(path)
+    file.write(json.dumps(locations))
+    finish_replace(file, path)
+
+
+def read_checkpoint(id):
+    # A checkpoint is only left behind by a run that didn't finish; it is
+    # newer than the rest of the saved data, so it replaces it.
+    try:
+        file = open('data/{0}_checkpoint.json'.format(id))
+        checkpoint_data = json.loads(file.read())
+        file.close()
+    except IOError:
+        return
+    except:
+        log_exception('{0}_checkpoint.json'.format(id))
+        return
+    
+    print 'Resuming from the checkpoint of the last execution of this script...'
+    global processed_loans, lender_locations, loan_locations, lender_loan_data, team_members, progress
+    processed_loans = checkpoint_data['processed_loans']
+    lender_locations = read_points(checkpoint_data['lender_locations'])
+    loan_locations = read_points(checkpoint_data['loan_locations'])
+    lender_loan_data = read_points(checkpoint_data['lender_loan_data'])
+    for lender_loc, loan_locs in lender_loan_data.iteritems():
+        lender_loan_data[lender_loc] = read_points(loan_locs)
+    team_members = checkpoint_data['team_members']
+    progress = checkpoint_data['progress']
+
+
+def write_checkpoint(id):
+    write_saved_locations()
+    
+    # Everything needed to resume is written to a single file, so that the
+    # data in it is always consistent.
+    path = 'data/{0}_checkpoint.json'.format(id)
+    file = open_for_replace(path)
+    file.write(json.dumps({
+        'processed_loans': processed_loans,
+        'lender_locations': lender_locations,
+        'loan_locations': loan_locations,
+        'lender_loan_data': lender_loan_data,
+        'team_members': team_members,
+        'progress': progress
+    }))
+    finish_replace(file, path)
+
+
+def remove_checkpoint(id):
+    try:
+        os.remove('data/{0}_checkpoint.json'.format(id))
+    except OSError:
+        pass
+
+
+def checkpoint(num_loans_processed = 0):
+    # Only checkpoint every so often, since the whole state is written each time.
+    checkpoint.num_loans_processed += num_loans_processed
+    if checkpoint.num_loans_processed >= CHECKPOINT_EVERY_LOANS or \
+       time.time() - checkpoint.last_time >= CHECKPOINT_EVERY_SECONDS:
+        write_checkpoint(checkpoint.file_id)
+        checkpoint.num_loans_processed = 0
+        checkpoint.last_time = time.time()
+
+
+def get_progress(key, default_items):
+    if key in progress:
+        return progress[key]['page'], progress[key]['items']
+    return 0, default_items
+
+
+def set_progress(key, page, items):
+    progress[key] = { 'page': page, 'items': items }
+    checkpoint()
+
+
+def clear_progress(key):
+    if key in progress:
+        del progress[key]
 
 
 #####################################################################
@@ -234,8 +433,7 @@ def write_data(id):
 #####################################################################
 
 def read_kiva_data(url):
-    stream = urllib.urlopen(url)
-    data_str = stream.read()
+    data_str = fetch('kiva', url)
     data_str = re.sub('\\\\\'', '\'', data_str)
 
     try:
@@ -247,27 +445,25 @@ def read_kiva_data(url):
         raise Exception(u'Couldn\'t parse JSON: {0}'.format(data_str))
 
 
+class InvalidLocationError(Exception):
+    # Raised when a lender's location can't ever be resolved (unlike other
+    # errors, e.g. network errors, which are worth retrying).
+    pass
+
+
 def raise_invalid_location(indent, lender_loc):
     try:
-        msg = u'{0}"{1}" is not a valid location according to Google Maps'.format(indent, lender_loc)
+        msg = u'{0}"{1}" is not a valid location according to the geocoders'.format(indent, lender_loc)
     except UnicodeEncodeError:
-        msg = u'{0}(cannot be displayed) is not a valid location according to Google Maps'.format(indent)
-    raise Exception(msg)
+        msg = u'{0}(cannot be displayed) is not a valid location according to the geocoders'.format(indent)
+    raise InvalidLocationError(msg)
 
 
 def fetch_lender_location(indent, lender):
     if 'whereabouts' not in lender or len(lender['whereabouts']) == 0:
-        raise Exception(u'{0} does not have any location set'.format(lender['uid']))
-    
-    lender_loc = lender['whereabouts'].lower()
-    if 'country_code' in lender:
-        lender_loc += ', ' + lender['country_code'].lower()
+        raise InvalidLocationError(u'{0} does not have any location set'.format(lender['uid']))
     
-    # Remove some URLs commonly found in the lender locations. TODO: use regex...
-    lender_loc = lender_loc.replace('http://www.kivafriends.org', '')
-    lender_loc = lender_loc.replace('http://kivafriends.org', '')
-    lender_loc = lender_loc.replace('www.kivafriends.org', '')
-    lender_loc = lender_loc.replace('kivafriends.org', '')
+    lender_loc = normalize_location(lender['whereabouts'], lender.get('country_code'))
     
     # Check the cache first.
     if lender_loc in locations:
@@ -276,24 +472,23 @@ def fetch_lender_location(indent, lender):
         
         return locations[lender_loc]            
     
-    # Fetch the lender's lat/lon from Google Maps.
+    # Look up the lender's lat/lon with the geocoders.
     try:
-        print u'{0}Fetching lender location "{1}" from Google Maps'.format(indent, lender_loc)
+        print u'{0}Looking up lender location "{1}"'.format(indent, lender_loc)
     except UnicodeEncodeError:
-        print u'{0}Fetching lender location (cannot be displayed) from Google Maps'.format(indent)
+        print u'{0}Looking up lender location (cannot be displayed)'.format(indent)
     
-    time.sleep(SECONDS_BETWEEN_GMAPS_QUERIES)
-    loc_url = urllib.urlopen(u'http://maps.googleapis.com/maps/geo?q={0}'.format(lender_loc).encode('utf-8'))
-    loc_data = json.loads(loc_url.read())
-    if 'Placemark' not in loc_data:
-        # The address was not found by Google Maps, so alert the user and exit.
+    point = geocode(lender_loc)
+    if point == NOT_FOUND:
+        # The address doesn't exist according to a remote geocoder, so alert the user and exit.
         locations[lender_loc] = -1
         raise_invalid_location(indent, lender_loc)
+    elif point is None:
+        # The address couldn't be resolved (e.g. it's not in the gazetteer and no remote
+        # geocoder is used), so it isn't saved, and can be looked up again later.
+        raise Exception(u'{0}Could not resolve lender location "{1}" with the geocoders'.format(indent, lender_loc))
     
-    coords = loc_data['Placemark'][0]['Point']['coordinates']
-    
-    # The lender location format: "<lat> <lon>"
-    location = '{0} {1}'.format(coords[1], coords[0])
+    location = pack_point(to_fixed(point[0]), to_fixed(point[1]))
     locations[lender_loc] = location
     return location
 
@@ -313,17 +508,50 @@ def fetch_lender_data(lender_id):
     if lender_loc not in lender_loan_data:
         lender_loan_data[lender_loc] = {}
     
-    # Fetch all the loans for this lender, starting with the newest.
+    # Fetch all the loans for this lender, unless they were already fetched
+    # by an interrupted execution of this script.
+    if 'lender_loans_to_process' in progress:
+        loans_to_process = progress['lender_loans_to_process']
+    else:
+        loans_to_process = fetch_lender_loans(lender, lender_id)
+        progress['lender_loans_to_process'] = loans_to_process
+    
+    # Add the loans to the data.
+    print u'Processing {0} new loans (since the last execution of this script).'.format(len(loans_to_process))
+    for loan in loans_to_process:
+        # Skip the loans processed before an interruption.
+        if loan['id'] in processed_loans:
+            continue
+        
+        loan_loc = loan['location']
+        if loan_loc not in loan_locations:
+            loan_locations[loan_loc] = 1
+        else:
+            loan_locations[loan_loc] += 1
+        
+        if loan_loc not in lender_loan_data[lender_loc]:
+            lender_loan_data[lender_loc][loan_loc] = {
+                'count': 1,
+                'distance': point_distance(lender_loc, loan_loc)
+            }
+        else:
+            lender_loan_data[lender_loc][loan_loc]['count'] += 1
+        
+        processed_loans[loan['id']] = { 'location': loan_loc, 'lenders': { lender_id: lender_loc } }
+    
+    clear_progress('lender_loans_to_process')
+
+
+def fetch_lender_loans(lender, lender_id):
+    # Fetch all the new loans for this lender, starting with the newest.
     print u'Fetching {0} loan(s) for lender {1}...'.format(lender['loan_count'], lender_id)
-    loans_to_process = []
-    page = 0
-    num_pages = 1
+    page, loans_to_process = get_progress('lender_loans', [])
+    num_pages = page + 1
     while True:
         page += 1
         if page > num_pages:
             break
         
-        time.sleep(SECONDS_BETWEEN_KIVA_QUERIES)
         print u' - Fetching page {0} of loans for lender {1}...'.format(page, lender_id)
         loans_data = read_kiva_data('http://api.kivaws.org/v1/lenders/{0}/loans.json?page={1}'.format(lender_id, page))
         
@@ -340,47 +568,30 @@ def fetch_lender_data(lender_id):
             else:
                 loans_to_process.insert(0, {
                     'id': loan_id,
-                    'location': loan['location']['geo']['pairs']
+                    'location': parse_point(loan['location']['geo']['pairs'])
                 })
         
-        # Once we reach a processed loan, we can exit knowing the rest
-        # are older and have already been processed.
-        if reached_processed_loan:
+        # Once we reach a processed loan (or the last page), we can exit knowing
+        # the rest are older and have already been processed. The last page isn't
+        # saved as progress, so a resumed execution doesn't fetch the next one.
+        if reached_processed_loan or page >= num_pages:
             break
-    
-    # Add the loans to the data.
-    print u'Processing {0} new loans (since the last execution of this script).'.format(len(loans_to_process))
-    for loan in loans_to_process:
-        loan_loc = loan['location']
-        if loan_loc not in loan_locations:
-            loan_locations[loan_loc] = 1
-        else:
-            loan_locations[loan_loc] += 1
         
-        if loan_loc not in lender_loan_data[lender_loc]:
-            lender_loc_split = lender_loc.partition(' ')
-            loan_loc_split = loan_loc.partition(' ')
-            lender_loan_data[lender_loc][loan_loc] = {
-                'count': 1,
-                'distance': haversine(lender_loc_split[0], lender_loc_split[2], loan_loc_split[0], loan_loc_split[2])
-            }
-        else:
-            lender_loan_data[lender_loc][loan_loc]['count'] += 1
-        
-        processed_loans[loan['id']] = 1
+        set_progress('lender_loans', page, loans_to_process)
+    
+    clear_progress('lender_loans')
+    return loans_to_process
 
 
 def fetch_lenders_for_loan(indent, loan_id):
-    lenders = []
-    
-    page = 0
-    num_pages = 1
+    progress_key = u'loan_lenders:{0}'.format(loan_id)
+    page, lenders = get_progress(progress_key, [])
+    num_pages = page + 1
     while True:
         page += 1
         if page > num_pages:
             break;
         
-        time.sleep(SECONDS_BETWEEN_KIVA_QUERIES)
         print u'{0}Fetching page {1} of lenders for loan {2}...'.format(indent, page, loan_id)
         lenders_data = read_kiva_data('http://api.kivaws.org/v1/loans/{0}/lenders.json?page={1}'.format(loan_id, page))
         
@@ -392,70 +603,223 @@ def fetch_lenders_for_loan(indent, loan_id):
         if 'lenders' in lenders_data:
             for lender in lenders_data['lenders']:
                 lenders.append(lender['uid'])
+        
+        set_progress(progress_key, page, lenders)
     
+    clear_progress(progress_key)
     return lenders
 
 
-def fetch_team_data(id):
-    teamData = read_kiva_data('http://api.kivaws.org/v1/teams/using_shortname/{0}.json'.format(id))
-    team = teamData['teams'][0]
+def parse_kiva_time(time_str):
+    return calendar.timegm(time.strptime(time_str, KIVA_TIME_FORMAT))
+
+
+def lend_cutoff(loans_to_process):
+    # Returns the posted date before which a lender's loans were all lent before the
+    # oldest of the loans was posted (or None if a loan's posted date is unknown).
+    posted_dates = [ loan.get('posted_date') for loan in loans_to_process ]
+    if len(posted_dates) == 0 or None in posted_dates:
+        return None
+    cutoff_time = parse_kiva_time(min(posted_dates)) - MAX_FUNDRAISING_SECONDS
+    return time.strftime(KIVA_TIME_FORMAT, time.gmtime(cutoff_time))
+
+
+def fetch_loans_for_lender(indent, lender_id, cutoff):
+    # A lender's loans are ordered by when they were lent to, so once a loan posted
+    # before [cutoff] is reached, the rest were all lent to before the loans being
+    # processed were posted.
+    progress_key = u'lender_loans:{0}'.format(lender_id)
+    page, loan_ids = get_progress(progress_key, [])
+    num_pages = page + 1
+    while True:
+        page += 1
+        if page > num_pages:
+            break;
+        
+        print u'{0}Fetching page {1} of loans for lender {2}...'.format(indent, page, lender_id)
+        loans_data = read_kiva_data('http://api.kivaws.org/v1/lenders/{0}/loans.json?page={1}'.format(lender_id, page))
+        
+        # Update the paging.
+        page = loans_data['paging']['page']
+        num_pages = loans_data['paging']['pages']
+        
+        # Add these loan ids to the list, stopping at the cutoff.
+        reached_cutoff = False
+        for loan in loans_data['loans']:
+            if cutoff is not None and loan.get('posted_date', cutoff) < cutoff:
+                reached_cutoff = True
+                break
+            loan_ids.append(str(loan['id']))
+        
+        set_progress(progress_key, page, loan_ids)
+        
+        if reached_cutoff:
+            break
     
-    # [lenders_in_team] holds a map of uid -> geo point, and
-    # [lender_locations*] hold maps of geo point -> count.
-    lenders_in_team = {}
-    lender_locations_tmp = {}
+    clear_progress(progress_key)
+    return loan_ids
+
+
+def add_team_member(sweep, lender):
+    # Only members whose location is invalid are recorded as -1; the others that
+    # failed are retried by the next sweep.
+    uid = lender['uid']
+    sweep['retry'].pop(uid, None)
+    try:
+        sweep['members'][uid] = fetch_lender_location('   -> ', lender)
+    except InvalidLocationError, e:
+        sweep['members'][uid] = -1
+        log_warning(u'Problem fetching location for lender {0}'.format(uid), e, 'lender_location')
+    except Exception, e:
+        sweep['members'].pop(uid, None)
+        sweep['retry'][uid] = { 'uid': uid, 'whereabouts': lender.get('whereabouts'), 'country_code': lender.get('country_code') }
+        log_warning(u'Problem fetching location for lender {0} (it will be retried)'.format(uid), e, 'lender_location')
+
+
+def fetch_team_members(team):
+    members = team_members['members']
     
-    # Fetch all the lenders in this team.
-    print u'Fetching data for {0} lenders in lending team {1}...'.format(team['member_count'], id)
-    page = 0
-    num_pages = 1
+    page, sweep = get_progress('team_members', None)
+    if sweep is None:
+        # Every so often, all the members are fetched again so that the ones
+        # who have left the team (or changed location) are reconciled. Otherwise
+        # only the newest members are fetched, up until a known member is reached.
+        full_sweep = len(members) == 0 or \
+            time.time() - team_members['last_full_sweep'] > SECONDS_BETWEEN_FULL_MEMBER_SWEEPS
+        if full_sweep:
+            print u'Fetching data for {0} lenders in lending team {1}...'.format(team['member_count'], team['shortname'])
+            sweep = { 'full_sweep': True, 'members': {}, 'loan_counts': {}, 'member_since': {}, 'retry': {} }
+        else:
+            print u'Fetching new lenders in lending team {0} ({1} are already known)...'.format(team['shortname'], len(members))
+            sweep = { 'full_sweep': False, 'members': members, 'loan_counts': team_members.setdefault('loan_counts', {}),
+                      'member_since': team_members.setdefault('member_since', {}), 'retry': team_members.setdefault('retry', {}) }
+            
+            # The members that failed last time are older than the newest known
+            # member, so paging won't reach them again.
+            for lender in sweep['retry'].values():
+                add_team_member(sweep, lender)
+    
+    full_sweep = sweep['full_sweep']
+    members_found = sweep['members']
+    loan_counts_found = sweep['loan_counts']
+    member_since_found = sweep.setdefault('member_since', {})
+    num_pages = page + 1
     while True:
         page += 1
         if page > num_pages:
             break;
         
-        time.sleep(SECONDS_BETWEEN_KIVA_QUERIES)
-        print u' - Fetching page {0} of lenders for lending team {1}...'.format(page, id)
-        lenders_data = read_kiva_data('http://api.kivaws.org/v1/teams/{0}/lenders.json?page={1}'.format(team['id'], page))
+        print u' - Fetching page {0} of lenders for lending team {1}...'.format(page, team['shortname'])
+        lenders_data = read_kiva_data('http://api.kivaws.org/v1/teams/{0}/lenders.json?sort_by=newest&page={1}'.format(team['id'], page))
         
         # Update the paging.
         page = lenders_data['paging']['page']
         num_pages = lenders_data['paging']['pages']
+        page_sizes['lenders'] = lenders_data['paging'].get('page_size', page_sizes['lenders'])
         
         # Add these lenders to the data.
+        reached_known_member = False
         for lender in lenders_data['lenders']:
-            if 'uid' in lender:
-                try:
-                    lender_loc = fetch_lender_location('   -> ', lender)
-                    lenders_in_team[lender['uid']] = lender_loc
-                    if lender_loc not in lender_locations_tmp:
-                        if lender_loc in lender_locations:
-                            # Cover the case where the location has already been saved.
-                            lender_locations_tmp[lender_loc] = lender_locations[lender_loc]
-                        else:
-                            lender_locations_tmp[lender_loc] = 1
-                    else:
-                        lender_locations_tmp[lender_loc] += 1
-                except Exception, e:
-                    log_warning(u'Problem fetching location for lender {0}'.format(lender['uid']), e)
-    
-    # Fetch all the loans for this team.
-    print u'Fetching data for {0} loans in lending team {1}...'.format(team['loan_count'], id)
-    loans_to_process = []
-    page = 0
-    num_pages = 1
+            if 'uid' not in lender:
+                continue
+            
+            if not full_sweep and lender['uid'] in members:
+                reached_known_member = True
+                continue
+            
+            if 'loan_count' in lender:
+                loan_counts_found[lender['uid']] = lender['loan_count']
+            if 'member_since' in lender:
+                member_since_found[lender['uid']] = lender['member_since']
+            
+            add_team_member(sweep, lender)
+        
+        set_progress('team_members', page, sweep)
+        
+        # Once we reach a known member, we can exit knowing the rest
+        # joined earlier and have already been fetched.
+        if reached_known_member:
+            break
+    
+    if full_sweep:
+        num_dropped = len([ uid for uid in members if uid not in members_found ])
+        if num_dropped > 0:
+            print u'Removed {0} lenders who are no longer in lending team {1}.'.format(num_dropped, team['shortname'])
+        team_members['last_full_sweep'] = time.time()
+    team_members['members'] = members_found
+    team_members['loan_counts'] = loan_counts_found
+    team_members['member_since'] = member_since_found
+    team_members['retry'] = sweep['retry']
+    
+    clear_progress('team_members')
+    return team_members['members']
+
+
+def fetch_team_data(id):
+    teamData = read_kiva_data('http://api.kivaws.org/v1/teams/using_shortname/{0}.json'.format(id))
+    team = teamData['teams'][0]
+    
+    # [lenders_in_team] holds a map of uid -> geo point, and
+    # [lender_locations_tmp] holds a map of geo point -> member count.
+    lenders_in_team = fetch_team_members(team)
+    lender_locations_tmp = {}
+    for lender_loc in lenders_in_team.itervalues():
+        if lender_loc == -1:
+            continue
+        if lender_loc not in lender_locations_tmp:
+            lender_locations_tmp[lender_loc] = 1
+        else:
+            lender_locations_tmp[lender_loc] += 1
+    
+    # Keep the counts of the lender locations that have already been saved
+    # in sync with the current team membership.
+    for lender_loc in lender_locations:
+        if lender_loc in lender_locations_tmp:
+            lender_locations[lender_loc] = lender_locations_tmp[lender_loc]
+    
+    # Fetch all the loans for this team, unless they were already fetched
+    # by an interrupted execution of this script.
+    if 'team_loans_to_process' in progress:
+        loans_to_process = progress['team_loans_to_process']
+    else:
+        loans_to_process = fetch_team_loans(team)
+        progress['team_loans_to_process'] = loans_to_process
+    
+    if len(loans_to_process) == 0:
+        print u'There are no new loans (since the last execution of this script).'
+        clear_progress('team_loans_to_process')
+        return
+    
+    # Add these loans to the data, using whichever strategy needs the fewest
+    # requests. An interrupted execution must finish with the same strategy.
+    if 'team_strategy' not in progress:
+        progress['team_strategy'] = plan_team_strategy(team, loans_to_process, lenders_in_team)
+    print u'Processing {0} new loans (since the last execution of this script).'.format(len(loans_to_process))
+    if progress['team_strategy'] == 'members':
+        process_team_loans_by_member(loans_to_process, lenders_in_team, lender_locations_tmp)
+    else:
+        process_team_loans_by_loan(loans_to_process, lenders_in_team, lender_locations_tmp)
+    
+    clear_progress('team_strategy')
+    clear_progress('team_loans_to_process')
+
+
+def fetch_team_loans(team):
+    print u'Fetching data for {0} loans in lending team {1}...'.format(team['loan_count'], team['shortname'])
+    page, loans_to_process = get_progress('team_loans', [])
+    num_pages = page + 1
     while True:
         page += 1
         if page > num_pages:
             break;
         
-        time.sleep(SECONDS_BETWEEN_KIVA_QUERIES)
-        print u' - Fetching page {0} of loans for lending team {1}...'.format(page, id)
+        print u' - Fetching page {0} of loans for lending team {1}...'.format(page, team['shortname'])
         loans_data = read_kiva_data('http://api.kivaws.org/v1/teams/{0}/loans.json?page={1}'.format(team['id'], page))
         
         # Update the paging.
         page = loans_data['paging']['page']
         num_pages = loans_data['paging']['pages']
+        page_sizes['loans'] = loans_data['paging'].get('page_size', page_sizes['loans'])
         
         # Add these loans to a list.
         reached_processed_loan = False
@@ -467,52 +831,394 @@ def fetch_team_data(id):
                 else:
                     loans_to_process.insert(0, {
                         'id': loan_id,
-                        'location': loan['location']['geo']['pairs']
+                        'location': parse_point(loan['location']['geo']['pairs']),
+                        'lender_count': loan.get('lender_count', 0),
+                        'posted_date': loan.get('posted_date')
                     })
         
+        set_progress('team_loans', page, loans_to_process)
+        
         # Once we reach a processed loan, we can exit knowing the rest
         # are older and have already been processed.
         if reached_processed_loan:
             break
     
-    # Add these loans to the data.
-    print u'Processing {0} new loans (since the last execution of this script).'.format(len(loans_to_process))
+    clear_progress('team_loans')
+    return loans_to_process
+
+
+def plan_team_strategy(team, loans_to_process, lenders_in_team):
+    # Estimate the requests needed to fetch the lenders of every new loan.
+    loan_requests = 0
     for loan in loans_to_process:
+        loan_requests += max(1, int(ceil(loan['lender_count'] / float(page_sizes['lenders']))))
+    
+    # Estimate the requests needed to fetch the loans of every member. Members
+    # are paged until the lend cutoff (see fetch_loans_for_lender), and their
+    # loans are assumed to be spread evenly since they became members, so the
+    # share of their loans after the cutoff is scanned (all of them if it's
+    # not known when they became members), plus the loan past the cutoff.
+    avg_loan_count = team['loan_count'] / float(max(1, team['member_count']))
+    loan_counts = team_members.get('loan_counts', {})
+    member_since = team_members.get('member_since', {})
+    cutoff = lend_cutoff(loans_to_process)
+    now = time.time()
+    member_requests = 0
+    for uid, lender_loc in lenders_in_team.iteritems():
+        if lender_loc == -1:
+            continue
+        loan_count = loan_counts.get(uid, avg_loan_count)
+        if cutoff is not None and uid in member_since:
+            member_seconds = max(1, now - parse_kiva_time(member_since[uid]))
+            loan_count = min(loan_count, loan_count * (now - parse_kiva_time(cutoff)) / member_seconds + 1)
+        member_requests += max(1, int(ceil(loan_count / float(page_sizes['loans']))))
+    
+    if member_requests < loan_requests:
+        strategy = 'members'
+        print u'Fetching the loans of each member (~{0} requests instead of ~{1}).'.format(member_requests, loan_requests)
+    else:
+        strategy = 'loans'
+        print u'Fetching the lenders of each loan (~{0} requests instead of ~{1}).'.format(loan_requests, member_requests)
+    return strategy
+
+
+def add_team_lender_loan(loan_loc, lender_id, lenders_in_team, lender_locations_tmp):
+    # Returns whether the lender is in the team (and so was added).
+    if lender_id not in lenders_in_team or lenders_in_team[lender_id] == -1:
+        return False
+    lender_loc = lenders_in_team[lender_id]
+    
+    if lender_loc not in lender_locations:
+        lender_locations[lender_loc] = lender_locations_tmp[lender_loc]
+    
+    if lender_loc not in lender_loan_data:
+        lender_loan_data[lender_loc] = {}
+    
+    if loan_loc not in lender_loan_data[lender_loc]:
+        lender_loan_data[lender_loc][loan_loc] = {
+            'count': 1,
+            'distance': point_distance(lender_loc, loan_loc)
+        }
+    else:
+        lender_loan_data[lender_loc][loan_loc]['count'] += 1
+    return True
+
+
+def add_team_loan_location(loan_loc):
+    if loan_loc not in loan_locations:
+        loan_locations[loan_loc] = 1
+    else:
+        loan_locations[loan_loc] += 1
+
+
+def process_team_loans_by_loan(loans_to_process, lenders_in_team, lender_locations_tmp):
+    for loan in loans_to_process:
+        # Skip the loans processed before an interruption.
+        if loan['id'] in processed_loans:
+            continue
+        
         try:
             lenders_for_loan = fetch_lenders_for_loan(' - ', loan['id'])
-            if len(lenders_for_loan) > 0:
-                # Add this location to the dict of all [loan_locations].
-                loan_loc = loan['location']
-                if loan_loc not in loan_locations:
-                    loan_locations[loan_loc] = 1
-                else:
-                    loan_locations[loan_loc] += 1
-                
-                # Intersect these lender ids with the ones in the team,
-                # adding the resulting set to the [lender_loan_data].
-                for lender_id in lenders_for_loan:
-                    if lender_id in lenders_in_team:
-                        lender_loc = lenders_in_team[lender_id]
-                        
-                        if lender_loc not in lender_locations:
-                            lender_locations[lender_loc] = lender_locations_tmp[lender_loc]
-                        
-                        if lender_loc not in lender_loan_data:
-                            lender_loan_data[lender_loc] = {}
-                        
-                        if loan_loc not in lender_loan_data[lender_loc]:
-                            lender_loc_split = lender_loc.partition(' ')
-                            loan_loc_split = loan_loc.partition(' ')
-                            lender_loan_data[lender_loc][loan_loc] = {
-                                'count': 1,
-                                'distance': haversine(lender_loc_split[0], lender_loc_split[2], loan_loc_split[0], loan_loc_split[2])
-                            }
-                        else:
-                            lender_loan_data[lender_loc][loan_loc]['count'] += 1
+            loan_record = { 'location': loan['location'], 'lenders': {} }
+            
+            # Intersect these lender ids with the ones in the team,
+            # adding the resulting set to the [lender_loan_data].
+            for lender_id in lenders_for_loan:
+                if add_team_lender_loan(loan['location'], lender_id, lenders_in_team, lender_locations_tmp):
+                    loan_record['lenders'][lender_id] = lenders_in_team[lender_id]
             
-            processed_loans[loan['id']] = 1
+            # Add this location to the dict of all [loan_locations], if any
+            # team lenders were added to the loan.
+            if len(loan_record['lenders']) > 0:
+                add_team_loan_location(loan['location'])
+            
+            processed_loans[loan['id']] = loan_record
+            checkpoint(1)
         except:
-            log_exception(u'loan {0}'.format(loan['id']))
+            log_exception(u'loan {0}'.format(loan['id']), category='loan')
+
+
+def process_team_loans_by_member(loans_to_process, lenders_in_team, lender_locations_tmp):
+    loans_by_id = {}
+    for loan in loans_to_process:
+        loans_by_id[loan['id']] = loan
+    
+    # [members_done] holds the members whose loans have been added, so an
+    # interrupted execution doesn't add them twice, and [loan_lenders] holds
+    # the lenders added to each loan so far.
+    members_done = progress.setdefault('members_done', {})
+    loan_lenders = progress.setdefault('loan_lenders', {})
+    cutoff = lend_cutoff(loans_to_process)
+    
+    for lender_id, lender_loc in lenders_in_team.iteritems():
+        if lender_loc == -1 or lender_id in members_done:
+            continue
+        
+        try:
+            for loan_id in fetch_loans_for_lender(' - ', lender_id, cutoff):
+                if loan_id in loans_by_id:
+                    add_team_lender_loan(loans_by_id[loan_id]['location'], lender_id, lenders_in_team, lender_locations_tmp)
+                    loan_lenders.setdefault(loan_id, {})[lender_id] = lender_loc
+            members_done[lender_id] = 1
+            checkpoint()
+        except:
+            # The loans are only marked as processed once every member's loans were added,
+            # so this stops here, and the checkpoint lets the next execution retry the member.
+            log_exception(u'lender {0}'.format(lender_id), category='lender')
+            raise
+    
+    # As with the by-loan strategy, a loan is only counted if any team lenders were added to it.
+    for loan in loans_to_process:
+        processed_loans[loan['id']] = { 'location': loan['location'], 'lenders': loan_lenders.get(loan['id'], {}) }
+        if len(processed_loans[loan['id']]['lenders']) > 0:
+            add_team_loan_location(loan['location'])
+    clear_progress('members_done')
+    clear_progress('loan_lenders')
+
+
+#####################################################################
+# 
+# Rendering Functions
+# 
+#####################################################################
+
+def data_paths(id):
+    return [
+        'data/{0}_lenders.csv'.format(id),
+        'data/{0}_loans.csv'.format(id),
+        'data/{0}_lender_loans.csv'.format(id)
+    ]
+
+
+def hash_files(paths):
+    content_hash = hashlib.sha1()
+    for path in paths:
+        try:
+            file = open(path, 'rb')
+            content_hash.update(file.read())
+            file.close()
+        except IOError:
+            pass
+        content_hash.update('\0')
+    return content_hash.hexdigest()
+
+
+def edge_maxes():
+    max_distance = 0
+    max_count = 0
+    for loan_locs in lender_loan_data.itervalues():
+        for lender_loan_obj in loan_locs.itervalues():
+            max_distance = max(max_distance, lender_loan_obj['distance'])
+            max_count = max(max_count, lender_loan_obj['count'])
+    return max_distance, max_count
+
+
+def edge_max_sort_value(max_distance, max_count):
+    # The max sortValue of the lender-loans (see draw_custom_map.R).
+    max_sort_value = 0
+    for loan_locs in lender_loan_data.itervalues():
+        for lender_loan_obj in loan_locs.itervalues():
+            range_idx = distance_range(lender_loan_obj['distance'], max_distance)
+            max_sort_value = max(max_sort_value, range_idx * max_count + lender_loan_obj['count'])
+    return max_sort_value
+
+
+def read_render_manifest(id):
+    try:
+        file = open('data/{0}_render.json'.format(id))
+        manifest = json.loads(file.read())
+        file.close()
+    except IOError:
+        return
+    except:
+        log_exception('{0}_render.json'.format(id))
+        return
+    
+    render_state['manifest'] = manifest
+    
+    # If the saved data is what was last drawn, remember what was drawn.
+    if manifest['data_hash'] == hash_files(data_paths(id)):
+        rendered_edges = {}
+        for lender_loc, loan_locs in lender_loan_data.iteritems():
+            for loan_loc, lender_loan_obj in loan_locs.iteritems():
+                rendered_edges[(lender_loc, loan_loc)] = lender_loan_obj['count']
+        render_state['rendered_edges'] = rendered_edges
+
+
+def find_new_edges():
+    # Returns the lender-loans that haven't been drawn, or None if any of the
+    # drawn ones has changed (so they all have to be drawn again).
+    rendered_edges = render_state['rendered_edges']
+    if rendered_edges is None:
+        return None
+    
+    new_edges = []
+    for lender_loc, loan_locs in lender_loan_data.iteritems():
+        for loan_loc, lender_loan_obj in loan_locs.iteritems():
+            rendered_count = rendered_edges.get((lender_loc, loan_loc))
+            if rendered_count is None:
+                new_edges.append((lender_loc, loan_loc, lender_loan_obj))
+            elif rendered_count != lender_loan_obj['count']:
+                return None
+    return new_edges
+
+
+def write_edge_list(path, edges):
+    file = open_for_replace(path)
+    writer = csv.writer(file, delimiter=';')
+    writer.writerow(['lender_lat', 'lender_lon', 'loan_lat', 'loan_lon', 'distance', 'count'])
+    for lender_loc, loan_loc, lender_loan_obj in edges:
+        lender_lat, lender_lon = unpack_point(lender_loc)
+        loan_lat, loan_lon = unpack_point(loan_loc)
+        writer.writerow([
+            format_fixed(lender_lat),
+            format_fixed(lender_lon),
+            format_fixed(loan_lat),
+            format_fixed(loan_lon),
+            lender_loan_obj['distance'],
+            lender_loan_obj['count']
+        ])
+    finish_replace(file, path)
+
+
+def write_new_edges(id, new_edges):
+    write_edge_list('data/{0}_new_lender_loans.csv'.format(id), new_edges)
+
+
+def distance_range(distance, max_distance):
+    # The distance range of the lender-loan's sortValue (see draw_custom_map.R).
+    range_len = max_distance / DISTANCE_RANGE_NUM
+    if range_len == 0:
+        return 0
+    return int(floor((max_distance - distance) / range_len))
+
+
+def sample_edges(sample_size, max_distance, max_count):
+    # Returns a sample of the lender-loans, stratified by distance range: every
+    # range gets a share of the sample in proportion to its lender-loan count,
+    # and its share is a sample weighted by count (keeping the lender-loans
+    # with the largest random^(1 / count), by Efraimidis and Spirakis). Also
+    # returns the max sortValue of all the lender-loans.
+    range_counts = {}
+    max_sort_value = 0
+    for loan_locs in lender_loan_data.itervalues():
+        for lender_loan_obj in loan_locs.itervalues():
+            range_idx = distance_range(lender_loan_obj['distance'], max_distance)
+            range_counts[range_idx] = range_counts.get(range_idx, 0) + lender_loan_obj['count']
+            max_sort_value = max(max_sort_value, range_idx * max_count + lender_loan_obj['count'])
+    
+    # Split the sample between the ranges by largest remainder.
+    total_count = sum(range_counts.itervalues())
+    shares = {}
+    for range_idx, count in range_counts.iteritems():
+        shares[range_idx] = sample_size * count / total_count
+    remainders = sorted(range_counts.iterkeys(), key=lambda range_idx: shares[range_idx] - sample_size * range_counts[range_idx] / float(total_count))
+    for range_idx in remainders[:sample_size - sum(shares.itervalues())]:
+        shares[range_idx] += 1
+    
+    samples = dict((range_idx, []) for range_idx in range_counts)
+    for lender_loc, loan_locs in lender_loan_data.iteritems():
+        for loan_loc, lender_loan_obj in loan_locs.iteritems():
+            range_idx = distance_range(lender_loan_obj['distance'], max_distance)
+            sample = samples[range_idx]
+            key = (random.random() ** (1.0 / lender_loan_obj['count']), lender_loc, loan_loc)
+            if len(sample) < shares[range_idx]:
+                heapq.heappush(sample, key)
+            elif len(sample) > 0 and key > sample[0]:
+                heapq.heapreplace(sample, key)
+    
+    # The lender-loans are drawn in order of sortValue, so the brightest end up on top.
+    edges = []
+    for range_idx, sample in samples.iteritems():
+        for key, lender_loc, loan_loc in sample:
+            edges.append((lender_loc, loan_loc, lender_loan_data[lender_loc][loan_loc]))
+    edges.sort(key=lambda edge: distance_range(edge[2]['distance'], max_distance) * max_count + edge[2]['count'])
+    return edges, max_sort_value
+
+
+def render_preview(id):
+    max_distance, max_count = edge_maxes()
+    edges, max_sort_value = sample_edges(options['preview'], max_distance, max_count)
+    print u'Drawing a preview with {0} lender-loans (images/{1}_preview.png)...'.format(len(edges), id)
+    write_edge_list('data/{0}_preview_lender_loans.csv'.format(id), edges)
+    
+    # The colors of the sample are relative to all the lender-loans.
+    process = subprocess.Popen([
+        'Rscript',
+        'draw_custom_map.R',
+        '--args',
+        id,
+        'preview',
+        repr(max_distance),
+        str(max_count),
+        str(max_sort_value)
+    ])
+    process.wait()
+
+
+def render_heatmap_map(id):
+    # Imported here, so that numpy is only needed for heatmaps.
+    import heatmap
+    
+    image_path = 'images/{0}_heatmap.png'.format(id)
+    print u'Drawing the heatmap to {0}...'.format(image_path)
+    paths = data_paths(id)
+    heatmap.render_heatmap(paths[2], paths[0], paths[1], image_path, heatmap.read_cfg())
+
+
+def render_map(id):
+    if options['heatmap']:
+        render_heatmap_map(id)
+        return
+    if options['preview'] is not None:
+        render_preview(id)
+        return
+    
+    manifest = render_state['manifest']
+    data_hash = hash_files(data_paths(id))
+    cfg_hash = hash_files([ 'custom_cfg.json' ])
+    max_distance, max_count = edge_maxes()
+    max_sort_value = edge_max_sort_value(max_distance, max_count)
+    
+    # The map is drawn in 2 layers: the lender-loan lines (saved on their own
+    # in data/) and the points, which are drawn over a copy of the lines.
+    mode = 'full'
+    if manifest is not None and manifest['cfg_hash'] == cfg_hash and \
+       os.path.exists('images/{0}.png'.format(id)) and os.path.exists('data/{0}_lines.png'.format(id)):
+        if manifest['data_hash'] == data_hash:
+            print u'The map is unchanged since it was last drawn (images/{0}.png).'.format(id)
+            return
+        
+        # The colors of the lines are relative to the max distance, count and sortValue,
+        # so the new lines can only be drawn over the old ones if those are the same.
+        new_edges = find_new_edges()
+        if new_edges is not None and manifest['max_distance'] == max_distance and manifest['max_count'] == max_count and \
+           manifest.get('max_sort_value') == max_sort_value:
+            print u'Drawing {0} new lender-loans over the last map...'.format(len(new_edges))
+            write_new_edges(id, new_edges)
+            mode = 'incremental'
+    
+    # Execute the R script for drawing the map.
+    process = subprocess.Popen([
+        'Rscript',
+        'draw_custom_map.R',
+        '--args',
+        id,
+        mode
+    ])
+    if process.wait() != 0:
+        return
+    
+    path = 'data/{0}_render.json'.format(id)
+    file = open_for_replace(path)
+    file.write(json.dumps({
+        'data_hash': data_hash,
+        'cfg_hash': cfg_hash,
+        'max_distance': max_distance,
+        'max_count': max_count,
+        'max_sort_value': max_sort_value
+    }))
+    finish_replace(file, path)
 
 
 #####################################################################
@@ -523,9 +1229,18 @@ def fetch_team_data(id):
 
 def validate_args(args):
     try:
-        if len(args) == 3:
-            if(args[1].upper() == 'L' or args[1].upper() == 'T'):
-                return True
+        if len(args) >= 3 and (args[1].upper() == 'L' or args[1].upper() == 'T'):
+            for arg in args[3:]:
+                name, sep, value = arg.partition('=')
+                if arg == '--heatmap':
+                    options['heatmap'] = True
+                elif arg == '--preview':
+                    options['preview'] = PREVIEW_SAMPLE_SIZE
+                elif name == '--preview' and int(value) > 0:
+                    options['preview'] = int(value)
+                else:
+                    return False
+            return True
     except:
         pass
     return False
@@ -534,12 +1249,16 @@ def validate_args(args):
 def main(*args):
     if validate_args(args) == False:
         print '\n  Proper Usage:\n'
-        print '  ' + args[0] + ' A B\n'
+        print '  ' + args[0] + ' A B [--heatmap] [--preview[=N]]\n'
         print '     A: Whether to fetch data for a specific lender or an entire lending team. L for lender, or T for team'
         print '     B: The ID of the lender or lending team'
+        print '     --heatmap: Draw the map as a density heatmap instead of drawing every lender-loan line'
+        print '     --preview: Quickly draw a preview of the saved map with a sample of N lender-loans (default {0})'.format(PREVIEW_SAMPLE_SIZE)
         print '\n  Examples:\n'
         print '     generate_map.py L seand: creates a map for user "seand"'
         print '     generate_map.py T buildkiva: creates a map for team "buildkiva"'
+        print '     generate_map.py T buildkiva --heatmap: creates a heatmap for team "buildkiva"'
+        print '     generate_map.py T buildkiva --preview=500: previews the saved map for team "buildkiva" with 500 lender-loans'
         return 0
     
     # Set meaningful argument names.
@@ -554,39 +1273,42 @@ def main(*args):
     # Initialize data for logging.
     log_exception.num_errors_logged = 0
     log_warning.num_warnings_logged = 0
-    log_exception.log_file = open('generate_custom_map.log', 'wb')
+    open_log('generate_custom_map.log')
+    
+    # Initialize data for checkpointing.
+    checkpoint.file_id = file_id
+    checkpoint.num_loans_processed = 0
+    checkpoint.last_time = time.time()
     
     create_dirs()
+    load_aliases()
     read_data(file_id)
     
     try:
-        if is_individual_lender:
-            fetch_lender_data(id)
-        else:
-            fetch_team_data(id)
-        
-        if len(lender_locations) == 0 or len(loan_locations) == 0:
-            print u'\nERROR: There was not enough data (no lenders with valid locations or no loans) to create a map.'
-            return
-        
-        write_data(file_id)
+        # A preview is drawn from the saved data, if there is any, without fetching new loans.
+        if options['preview'] is None or len(lender_loan_data) == 0:
+            if is_individual_lender:
+                fetch_lender_data(id)
+            else:
+                fetch_team_data(id)
+            
+            if len(lender_locations) == 0 or len(loan_locations) == 0:
+                print u'\nERROR: There was not enough data (no lenders with valid locations or no loans) to create a map.'
+                return
+            
+            write_data(file_id)
+            remove_checkpoint(file_id)
         
-        # Execute the R script for drawing the map.
-        process = subprocess.Popen([
-            'Rscript',
-            'draw_custom_map.R',
-            '--args',
-            file_id
-        ])
-        process.wait()
-    except SystemExit:
-        # Write the data that we have before exiting.
-        write_data(file_id)
+        render_map(file_id)
+    except (SystemExit, KeyboardInterrupt):
+        # Checkpoint the data that we have before exiting.
+        write_checkpoint(file_id)
     except Exception, e:
         print u'ERROR: {0}'.format(e)
+        write_checkpoint(file_id)
     
     # Cleanup.
-    log_exception.log_file.close()
+    close_log()
 
 
 if __name__ == '__main__':
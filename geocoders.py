@@ -0,0 +1,284 @@
+import  sys, os, json, mmap, struct, zlib
+from    location_normalizer import canonicalize
+from    rate_control import fetch
+
+#####################################################################
+#
+#  This module resolves the canonical location strings built by
+#  location_normalizer.py to lat/lon points. geocode() tries each
+#  backend in [GEOCODER_BACKENDS] in order, and returns the first
+#  point found. If there isn't one, it returns [NOT_FOUND] if a
+#  remote backend answered that the location doesn't exist (so it
+#  can be saved as invalid), or None if it's only unresolved (e.g.
+#  it's not in the gazetteer, or the remote backend answered with an
+#  error), so it can be looked up again later:
+#   - gazetteer: a local GeoNames-style gazetteer, looked up in a
+#     prebuilt index file (see build_gazetteer_index)
+#   - google: the Google Maps API, paced by rate_control.py
+#
+#  The backends can be chosen with the KIVA_GEOCODERS environment
+#  variable, e.g. KIVA_GEOCODERS=gazetteer to never use the network.
+#
+#  To build the gazetteer index:
+#
+#  python geocoders.py <cities file> [admin1 codes file]
+#    cities file: a GeoNames dump, e.g. cities1000.txt
+#    admin1 codes file: e.g. admin1CodesASCII.txt, so that lookups
+#      can use the lender's region ("portland, or, US")
+#
+#####################################################################
+#
+#  Gazetteer Index Format
+#
+#  Names are keyed as "<name>|<CC>" and "<name>|<region>|<CC>", and
+#  the region names of every country (if the admin1 codes file was
+#  given) as "|<region>|<CC>". The keys are hashed into buckets. The
+#  file holds:
+#   - a header: 'KGZ2', the number of buckets, and whether it has the
+#     region names
+#   - the bucket table: the offset of each bucket within the records
+#     (plus the end offset of the last one)
+#   - the records: "<key>\t<lat>\t<lon>\n", grouped by bucket
+#
+#  A lookup hashes the key, reads its bucket's offsets, and scans
+#  the few records in that bucket.
+#
+#  Only the first part of a location string is looked up as a city on
+#  its own ("<name>|<CC>"); later parts are only if they aren't a
+#  region of the country (without the region names, they never are),
+#  so e.g. "seattle area, washington, US" isn't taken for Washington,
+#  DC, and is left to the remote backends instead.
+#
+#####################################################################
+
+
+GAZETTEER_INDEX_FILE_NAME = 'gazetteer.idx'
+GAZETTEER_MAGIC = 'KGZ2'
+GAZETTEER_HEADER = struct.Struct('<4sII')
+GAZETTEER_KEYS_PER_BUCKET = 4
+
+GEOCODER_BACKENDS = os.environ.get('KIVA_GEOCODERS', 'gazetteer,google').split(',')
+
+# Returned by the remote backends (and geocode()) when the location doesn't exist.
+NOT_FOUND = -1
+
+# Status codes of the Google Maps API meaning the location doesn't exist
+# (602: unknown address, 603: unavailable address).
+GOOGLE_NOT_FOUND_CODES = (602, 603)
+
+# Column indices of the GeoNames dump.
+GEONAMES_NAME = 1
+GEONAMES_ASCII_NAME = 2
+GEONAMES_ALTERNATE_NAMES = 3
+GEONAMES_LAT = 4
+GEONAMES_LON = 5
+GEONAMES_COUNTRY_CODE = 8
+GEONAMES_ADMIN1_CODE = 10
+GEONAMES_POPULATION = 14
+
+
+#####################################################################
+#
+# Gazetteer Functions
+#
+#####################################################################
+
+def gazetteer_key(parts):
+    return u'|'.join(parts).encode('utf-8')
+
+
+def gazetteer_bucket(key, num_buckets):
+    return (zlib.crc32(key) & 0xffffffff) % num_buckets
+
+
+def open_gazetteer(path = GAZETTEER_INDEX_FILE_NAME):
+    try:
+        file = open(path, 'rb')
+    except IOError:
+        return None
+
+    index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    file.close()
+    if index[0:3] == GAZETTEER_MAGIC[0:3] and index[0:4] != GAZETTEER_MAGIC:
+        print u'Warning: {0} was built by an older version of geocoders.py, so it isn\'t used until it\'s built again.'.format(path)
+        return None
+    if index[0:4] != GAZETTEER_MAGIC:
+        raise Exception(u'{0} is not a gazetteer index'.format(path))
+    return index
+
+
+def gazetteer_has_regions(index):
+    return GAZETTEER_HEADER.unpack_from(index, 0)[2] == 1
+
+
+def gazetteer_lookup(index, key):
+    num_buckets = GAZETTEER_HEADER.unpack_from(index, 0)[1]
+    bucket = gazetteer_bucket(key, num_buckets)
+    records_start = GAZETTEER_HEADER.size + 4 * (num_buckets + 1)
+    start, end = struct.unpack_from('<II', index, GAZETTEER_HEADER.size + 4 * bucket)
+
+    for record in index[records_start + start:records_start + end].splitlines():
+        record_key, lat, lon = record.split('\t')
+        if record_key == key:
+            return float(lat), float(lon)
+    return None
+
+
+def gazetteer_geocode(loc_str):
+    if not hasattr(gazetteer_geocode, 'index'):
+        gazetteer_geocode.index = open_gazetteer()
+    if gazetteer_geocode.index is None:
+        return None
+
+    # The location string is "<place>, ..., <CC>"; try each part as the
+    # city, first along with the part after it as the region.
+    parts = loc_str.split(u', ')
+    if len(parts) < 2:
+        return None
+    country_code = parts[-1]
+    place_parts = parts[:-1]
+
+    index = gazetteer_geocode.index
+    for i in range(len(place_parts)):
+        keys = []
+        if i + 1 < len(place_parts):
+            keys.append(gazetteer_key([ place_parts[i], place_parts[i + 1], country_code ]))
+        if i == 0 or (gazetteer_has_regions(index) and gazetteer_lookup(index, gazetteer_key([ u'', place_parts[i], country_code ])) is None):
+            keys.append(gazetteer_key([ place_parts[i], country_code ]))
+
+        for key in keys:
+            point = gazetteer_lookup(index, key)
+            if point is not None:
+                return point
+    return None
+
+
+def read_admin1_names(path):
+    # Maps "<CC>.<admin1 code>" to the canonical names of the region.
+    admin1_names = {}
+    file = open(path, 'r')
+    for line in file:
+        row = unicode(line, 'utf-8').rstrip(u'\n').split(u'\t')
+        if len(row) < 3:
+            continue
+        code = row[0].partition(u'.')[2]
+        admin1_names[row[0]] = set([ canonicalize(code), canonicalize(row[1]), canonicalize(row[2]) ])
+    file.close()
+    return admin1_names
+
+
+def build_gazetteer_index(cities_path, admin1_path = None, index_path = GAZETTEER_INDEX_FILE_NAME):
+    admin1_names = {}
+    if admin1_path is not None:
+        admin1_names = read_admin1_names(admin1_path)
+
+    # Keep the most populous place for every key.
+    places = {}
+    file = open(cities_path, 'r')
+    for line in file:
+        row = unicode(line, 'utf-8').rstrip(u'\n').split(u'\t')
+        if len(row) <= GEONAMES_POPULATION:
+            continue
+
+        country_code = row[GEONAMES_COUNTRY_CODE].upper()
+        population = int(row[GEONAMES_POPULATION] or 0)
+        point = (population, row[GEONAMES_LAT], row[GEONAMES_LON])
+
+        names = set([ canonicalize(row[GEONAMES_NAME]), canonicalize(row[GEONAMES_ASCII_NAME]) ])
+        for name in row[GEONAMES_ALTERNATE_NAMES].split(u','):
+            names.add(canonicalize(name))
+        names.discard(u'')
+        regions = admin1_names.get(u'{0}.{1}'.format(country_code, row[GEONAMES_ADMIN1_CODE]), set())
+
+        for name in names:
+            keys = [ gazetteer_key([ name, country_code ]) ]
+            for region in regions:
+                keys.append(gazetteer_key([ name, region, country_code ]))
+            for key in keys:
+                if key not in places or places[key][0] < population:
+                    places[key] = point
+    file.close()
+
+    # The region names are marked, so that lookups don't take them for cities.
+    for code, regions in admin1_names.iteritems():
+        for region in regions:
+            places[gazetteer_key([ u'', region, code.partition(u'.')[0] ])] = (0, 0, 0)
+
+    # Group the records by bucket, and write them after the bucket table.
+    num_buckets = max(1, len(places) / GAZETTEER_KEYS_PER_BUCKET)
+    buckets = [ [] for i in xrange(num_buckets) ]
+    for key, point in places.iteritems():
+        buckets[gazetteer_bucket(key, num_buckets)].append('{0}\t{1}\t{2}\n'.format(key, point[1], point[2]))
+
+    offsets = [ 0 ]
+    for bucket in buckets:
+        offsets.append(offsets[-1] + sum(len(record) for record in bucket))
+
+    file = open(index_path + '.tmp', 'wb')
+    file.write(GAZETTEER_HEADER.pack(GAZETTEER_MAGIC, num_buckets, 1 if len(admin1_names) > 0 else 0))
+    file.write(struct.pack('<{0}I'.format(len(offsets)), *offsets))
+    for bucket in buckets:
+        file.write(''.join(bucket))
+    file.close()
+    os.rename(index_path + '.tmp', index_path)
+
+    return len(places)
+
+
+#####################################################################
+#
+# Remote Geocoder Functions
+#
+#####################################################################
+
+def google_geocode(loc_str):
+    try:
+        loc_data = json.loads(fetch('gmaps', u'http://maps.googleapis.com/maps/geo?q={0}'.format(loc_str).encode('utf-8')))
+    except ValueError:
+        return None
+
+    if 'Placemark' not in loc_data:
+        status = loc_data.get('status') or loc_data.get('Status', {}).get('code')
+        if status in GOOGLE_NOT_FOUND_CODES or status == 'ZERO_RESULTS':
+            return NOT_FOUND
+        return None
+
+    coords = loc_data['Placemark'][0]['Point']['coordinates']
+    return coords[1], coords[0]
+
+
+#####################################################################
+#
+# Main + Other Functions
+#
+#####################################################################
+
+BACKEND_FUNCTIONS = {
+    'gazetteer': gazetteer_geocode,
+    'google': google_geocode
+}
+
+
+def geocode(loc_str):
+    result = None
+    for backend in GEOCODER_BACKENDS:
+        point = BACKEND_FUNCTIONS[backend](loc_str)
+        if point == NOT_FOUND:
+            result = NOT_FOUND
+        elif point is not None:
+            return point
+    return result
+
+
+def main(*args):
+    if len(args) < 2:
+        print 'Usage: ' + args[0] + ' <cities file> [admin1 codes file]'
+        return 0
+
+    print 'Building the gazetteer index from {0}...'.format(args[1])
+    num_keys = build_gazetteer_index(args[1], args[2] if len(args) > 2 else None)
+    print 'Wrote {0} place names to {1}.'.format(num_keys, GAZETTEER_INDEX_FILE_NAME)
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
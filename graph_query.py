@@ -0,0 +1,278 @@
+import  sys, os, csv, json
+from    coordinates import to_fixed, format_fixed, pack_point, unpack_point, parse_point
+
+#####################################################################
+#
+#  This module answers queries over the aggregated lender-loan data
+#  (lender_loans.csv and the location files) without scanning it
+#  again for every query. load_graph() reads the data once and
+#  builds:
+#   - edges: a list of (lender point, loan point, count, distance)
+#   - lenders/loans: maps of point -> point_info (idx, lat, lon,
+#     count, and for lenders the country code)
+#   - from_lender/to_loan: maps of point -> indices into [edges], so
+#     the edges of a point can be found in both directions
+#   - by_distance/by_count: indices into [edges], sorted by distance
+#     and by count (descending), for top-k queries
+#   - countries: map of country code -> rollup of the edges of the
+#     lenders in that country (lenders, edges, count, distance)
+#   - country_lenders: map of country code -> lender points
+#
+#  Points are packed by coordinates.py. The query results are lists
+#  of edges, which write_edges() writes in the format of
+#  lender_loans.csv, so they can be drawn by kiva.R or heatmap.py.
+#
+#  It works on both the world map data (lender_loans.csv,
+#  lender_locations.csv, loan_locations.csv, locations.json) and the
+#  custom map data (data/<id>_lender_loans.csv, data/<id>_lenders.csv,
+#  data/<id>_loans.csv, data/saved_locations.json).
+#
+#  To execute:
+#
+#  python graph_query.py <query> [args] [--data=<prefix>] [--out=<csv>]
+#    top <k> <distance|count>: the k longest or largest edges
+#    lender <lat> <lon>: the edges from the lender point
+#    loan <lat> <lon>: the edges to the loan point
+#    country <country code>: the edges from lenders in the country
+#    countries: the rollup of every lender country
+#    --data: e.g. data/t_buildkiva_ to query a custom map
+#    --out: write the edges to a csv file instead of printing them
+#
+#####################################################################
+
+
+def read_rows(path):
+    # Yields the rows of a ';' separated csv file as dicts keyed by column.
+    file = open(path, 'r')
+    reader = csv.reader(file, delimiter=';')
+    header = reader.next()
+    for row in reader:
+        yield dict(zip(header, row))
+    file.close()
+
+
+def read_points(path):
+    # Returns the points in the csv file, and a map of idx -> point if the file has indices.
+    points = {}
+    idx_to_point = {}
+    try:
+        for row in read_rows(path):
+            point = pack_point(to_fixed(row['lat']), to_fixed(row['lon']))
+            if 'idx' in row:
+                idx_to_point[int(row['idx'])] = point
+            points[point] = { 'idx': int(row.get('idx', len(points))), 'lat': row['lat'], 'lon': row['lon'], 'count': int(row['count']) }
+    except IOError:
+        pass
+    return points, idx_to_point
+
+
+def add_point(points, point, lat, lon):
+    # Edges can point to points that aren't in the location files (e.g. if
+    # those files are missing), so they are added with the next idx.
+    if point not in points:
+        points[point] = { 'idx': len(points), 'lat': lat, 'lon': lon, 'count': 0 }
+
+
+def read_lender_countries(path, lenders, idx_to_lender):
+    # The keys of the location cache end with the lender's country code; its
+    # values are lender idx in the world map data, or points in the custom
+    # map data (packed, or "<lat> <lon>" if saved by older versions of
+    # generate_custom_map.py; -1 if invalid). Every lender point is given
+    # the country of most of its location strings.
+    try:
+        file = open(path, 'r')
+        locations = json.loads(file.read())
+        file.close()
+    except IOError:
+        return
+
+    votes = {}
+    for loc_str, value in locations.iteritems():
+        if value == -1:
+            continue
+        if len(idx_to_lender) > 0:
+            point = idx_to_lender.get(value)
+        elif isinstance(value, basestring):
+            point = parse_point(value)
+        else:
+            point = value
+        country_code = loc_str.rpartition(u', ')[2]
+        if point not in lenders or len(country_code) != 2:
+            continue
+        point_votes = votes.setdefault(point, {})
+        point_votes[country_code] = point_votes.get(country_code, 0) + 1
+
+    for point, point_votes in votes.iteritems():
+        lenders[point]['country'] = min(point_votes.iterkeys(), key=lambda code: (-point_votes[code], code))
+
+
+def load_graph(prefix = ''):
+    # Custom map files are <prefix>lenders.csv etc, and their location cache is
+    # saved_locations.json next to them; the world map files have no prefix.
+    if prefix == '':
+        paths = [ 'lender_loans.csv', 'lender_locations.csv', 'loan_locations.csv', 'locations.json' ]
+    else:
+        paths = [ prefix + 'lender_loans.csv', prefix + 'lenders.csv', prefix + 'loans.csv',
+                  os.path.join(os.path.dirname(prefix), 'saved_locations.json') ]
+
+    lenders, idx_to_lender = read_points(paths[1])
+    loans, idx_to_loan = read_points(paths[2])
+    read_lender_countries(paths[3], lenders, idx_to_lender)
+
+    graph = {
+        'edges': [],
+        'lenders': lenders,
+        'loans': loans,
+        'from_lender': {},
+        'to_loan': {},
+        'countries': {},
+        'country_lenders': {}
+    }
+
+    edges = graph['edges']
+    for row in read_rows(paths[0]):
+        lender_loc = pack_point(to_fixed(row['lender_lat']), to_fixed(row['lender_lon']))
+        loan_loc = pack_point(to_fixed(row['loan_lat']), to_fixed(row['loan_lon']))
+        add_point(lenders, lender_loc, row['lender_lat'], row['lender_lon'])
+        add_point(loans, loan_loc, row['loan_lat'], row['loan_lon'])
+
+        graph['from_lender'].setdefault(lender_loc, []).append(len(edges))
+        graph['to_loan'].setdefault(loan_loc, []).append(len(edges))
+        edges.append((lender_loc, loan_loc, int(row['count']), float(row['distance'])))
+
+    graph['by_distance'] = sorted(xrange(len(edges)), key=lambda i: edges[i][3], reverse=True)
+    graph['by_count'] = sorted(xrange(len(edges)), key=lambda i: edges[i][2], reverse=True)
+
+    for lender_loc, edge_indices in graph['from_lender'].iteritems():
+        country_code = lenders[lender_loc].get('country')
+        if country_code is None:
+            continue
+        rollup = graph['countries'].setdefault(country_code, { 'lenders': 0, 'edges': 0, 'count': 0, 'distance': 0.0 })
+        graph['country_lenders'].setdefault(country_code, []).append(lender_loc)
+        rollup['lenders'] += 1
+        rollup['edges'] += len(edge_indices)
+        for i in edge_indices:
+            rollup['count'] += edges[i][2]
+            rollup['distance'] += edges[i][2] * edges[i][3]
+
+    return graph
+
+
+#####################################################################
+#
+# Query Functions
+#
+#####################################################################
+
+def top_edges(graph, k, key = 'distance'):
+    return [ graph['edges'][i] for i in graph['by_' + key][:k] ]
+
+
+def edges_from_lender(graph, lat, lon):
+    point = pack_point(to_fixed(lat), to_fixed(lon))
+    return [ graph['edges'][i] for i in graph['from_lender'].get(point, []) ]
+
+
+def edges_to_loan(graph, lat, lon):
+    point = pack_point(to_fixed(lat), to_fixed(lon))
+    return [ graph['edges'][i] for i in graph['to_loan'].get(point, []) ]
+
+
+def edges_from_country(graph, country_code):
+    edges = []
+    for lender_loc in graph['country_lenders'].get(country_code, []):
+        edges.extend(graph['edges'][i] for i in graph['from_lender'][lender_loc])
+    return edges
+
+
+def country_rollups(graph):
+    # The distance of every rollup is the mean distance of its lender-loans.
+    rollups = {}
+    for country_code, rollup in graph['countries'].iteritems():
+        rollups[country_code] = dict(rollup)
+        rollups[country_code]['distance'] = rollup['distance'] / max(rollup['count'], 1)
+    return rollups
+
+
+def write_edges(graph, edges, path):
+    # Writes the edges in the format of lender_loans.csv, in the given order.
+    file = open(path, 'wb')
+    writer = csv.writer(file, delimiter=';')
+    writer.writerow(['lender_idx', 'loan_idx', 'count', 'distance', 'lender_lat', 'lender_lon', 'loan_lat', 'loan_lon'])
+    for lender_loc, loan_loc, count, distance in edges:
+        lender_lat, lender_lon = unpack_point(lender_loc)
+        loan_lat, loan_lon = unpack_point(loan_loc)
+        writer.writerow([
+            graph['lenders'][lender_loc]['idx'],
+            graph['loans'][loan_loc]['idx'],
+            count,
+            distance,
+            format_fixed(lender_lat),
+            format_fixed(lender_lon),
+            format_fixed(loan_lat),
+            format_fixed(loan_lon)
+        ])
+    file.close()
+
+
+#####################################################################
+#
+# Main + Other Functions
+#
+#####################################################################
+
+def print_usage(script):
+    print 'Usage: ' + script + ' <query> [args] [--data=<prefix>] [--out=<csv>]'
+    print '  top <k> <distance|count>'
+    print '  lender <lat> <lon>'
+    print '  loan <lat> <lon>'
+    print '  country <country code>'
+    print '  countries'
+
+
+def main(*args):
+    options = { '--data': '', '--out': None }
+    query = []
+    for arg in args[1:]:
+        name, sep, value = arg.partition('=')
+        if name in options and sep == '=':
+            options[name] = value
+        else:
+            query.append(arg)
+
+    queries = {
+        'top': (2, lambda graph: top_edges(graph, int(query[1]), query[2])),
+        'lender': (2, lambda graph: edges_from_lender(graph, query[1], query[2])),
+        'loan': (2, lambda graph: edges_to_loan(graph, query[1], query[2])),
+        'country': (1, lambda graph: edges_from_country(graph, query[1].upper())),
+        'countries': (0, None)
+    }
+    if len(query) == 0 or query[0] not in queries or len(query) != queries[query[0]][0] + 1 or \
+       (query[0] == 'top' and query[2] not in ('distance', 'count')):
+        print_usage(args[0])
+        return 0
+
+    graph = load_graph(options['--data'])
+
+    if query[0] == 'countries':
+        rollups = country_rollups(graph)
+        print 'country;lenders;edges;count;mean_distance'
+        for country_code in sorted(rollups.iterkeys(), key=lambda code: -rollups[code]['count']):
+            rollup = rollups[country_code]
+            print '{0};{1};{2};{3};{4:.1f}'.format(country_code, rollup['lenders'], rollup['edges'], rollup['count'], rollup['distance'])
+        return 0
+
+    edges = queries[query[0]][1](graph)
+    if options['--out'] is not None:
+        write_edges(graph, edges, options['--out'])
+        print 'Wrote {0} lender-loans to {1}.'.format(len(edges), options['--out'])
+    else:
+        print 'lender_lat;lender_lon;loan_lat;loan_lon;count;distance'
+        for lender_loc, loan_loc, count, distance in edges:
+            lender_lat, lender_lon = unpack_point(lender_loc)
+            loan_lat, loan_lon = unpack_point(loan_loc)
+            print ';'.join([ format_fixed(lender_lat), format_fixed(lender_lon), format_fixed(loan_lat), format_fixed(loan_lon), str(count), str(distance) ])
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -0,0 +1,254 @@
+import  sys, csv, json, struct, zlib
+import  numpy as np
+
+#####################################################################
+#
+#  This module draws a map as a density heatmap instead of drawing
+#  every lender-loan line. The great circle of every lender-loan is
+#  sampled into a 2D histogram at the output resolution, streaming
+#  over the lender-loans in chunks, so drawing takes about the same
+#  memory no matter how many lender-loans there are (the time grows
+#  with the lender-loans and the length of their arcs). The lender
+#  and loan points are accumulated into their own histograms and
+#  drawn on top.
+#
+#  The histograms are tone mapped (log or gamma, see "heatmap" in
+#  custom_cfg.json) and colored with the palettes of custom_cfg.json.
+#  The continents aren't drawn; only the background color is.
+#
+#  To execute:
+#
+#  python heatmap.py <lender-loans csv> <lenders csv> <loans csv> <png> [cfg]
+#    The csv files can be the ones of a custom map (data/<id>_*.csv)
+#    or of the Kiva world map (lender_loans.csv, lender_locations.csv
+#    and loan_locations.csv); their columns are found by name.
+#
+#####################################################################
+
+
+EDGES_PER_CHUNK = 1 << 16
+SAMPLES_PER_CHUNK = 1 << 20
+ADD_AT_MAX_FRACTION = 16
+DEFAULT_TONE_MAPPING = 'log'
+DEFAULT_GAMMA = 0.25
+
+
+#####################################################################
+#
+# Accumulation Functions
+#
+#####################################################################
+
+def read_csv_chunks(path, columns, rows_per_chunk):
+    # Yields the given columns of the csv file as float arrays, a chunk of rows at a time.
+    file = open(path, 'r')
+    reader = csv.reader(file, delimiter=';')
+    header = reader.next()
+    indices = [ header.index(column) for column in columns ]
+
+    rows = []
+    for row in reader:
+        rows.append([ float(row[i]) for i in indices ])
+        if len(rows) >= rows_per_chunk:
+            yield np.array(rows).T
+            rows = []
+    if len(rows) > 0:
+        yield np.array(rows).T
+    file.close()
+
+
+def to_unit_vectors(lat, lon):
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.stack([ np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat) ], axis=-1)
+
+
+def pixel_indices(shape, lat, lon):
+    # Returns the flat index of the pixel of every point.
+    height, width = shape
+    x = np.clip(((lon + 180.0) / 360.0 * width).astype(np.int64), 0, width - 1)
+    y = np.clip(((90.0 - lat) / 180.0 * height).astype(np.int64), 0, height - 1)
+    return y * width + x
+
+
+def add_pixels(hist, pixels, weights):
+    # A bincount costs as much as the whole histogram, so batches much
+    # smaller than it are added with np.add.at, which only costs as much
+    # as the batch.
+    if len(pixels) * ADD_AT_MAX_FRACTION < hist.size:
+        np.add.at(hist, np.unravel_index(pixels, hist.shape), weights)
+    else:
+        hist += np.bincount(pixels, weights=weights, minlength=hist.size).reshape(hist.shape)
+
+
+def add_points(hist, lat, lon, weights):
+    add_pixels(hist, pixel_indices(hist.shape, lat, lon), weights)
+
+
+def add_arcs(hist, lat1, lon1, lat2, lon2, counts):
+    height, width = hist.shape
+    p1 = to_unit_vectors(lat1, lon1)
+    p2 = to_unit_vectors(lat2, lon2)
+    angle = np.arccos(np.clip(np.sum(p1 * p2, axis=-1), -1.0, 1.0))
+
+    # Sample every arc about once per pixel it crosses. Arcs are grouped by
+    # a power-of-two number of samples, so each group is a single array op.
+    # The samples of all the groups are added to the histogram together,
+    # SAMPLES_PER_CHUNK at a time.
+    arc_pixels = angle / (2 * np.pi) * width
+    num_samples = 2 ** np.ceil(np.log2(np.maximum(arc_pixels, 2))).astype(np.int64)
+    batch_pixels = []
+    batch_weights = []
+    batch_size = 0
+
+    for n in np.unique(num_samples):
+        group = np.nonzero(num_samples == n)[0]
+        for start in xrange(0, len(group), max(1, SAMPLES_PER_CHUNK / n)):
+            edges = group[start:start + max(1, SAMPLES_PER_CHUNK / n)]
+            a = angle[edges][:, np.newaxis]
+            t = np.linspace(0.0, 1.0, n)[np.newaxis, :]
+
+            # Spherical linear interpolation (a plain lerp for coincident points).
+            sin_a = np.sin(a)
+            safe = sin_a > 1e-9
+            w1 = np.where(safe, np.sin((1 - t) * a) / np.where(safe, sin_a, 1), 1 - t)
+            w2 = np.where(safe, np.sin(t * a) / np.where(safe, sin_a, 1), t)
+            p = w1[..., np.newaxis] * p1[edges][:, np.newaxis, :] + w2[..., np.newaxis] * p2[edges][:, np.newaxis, :]
+
+            lat = np.degrees(np.arctan2(p[..., 2], np.hypot(p[..., 0], p[..., 1])))
+            lon = np.degrees(np.arctan2(p[..., 1], p[..., 0]))
+
+            # Each sample carries its share of the lender-loan count, so an arc
+            # adds about [count] to every pixel it crosses.
+            weights = counts[edges][:, np.newaxis] * np.maximum(arc_pixels[edges], 1)[:, np.newaxis] / n
+            batch_pixels.append(pixel_indices(hist.shape, lat.ravel(), lon.ravel()))
+            batch_weights.append(np.broadcast_to(weights, lat.shape).ravel())
+            batch_size += lat.size
+
+            if batch_size >= SAMPLES_PER_CHUNK:
+                add_pixels(hist, np.concatenate(batch_pixels), np.concatenate(batch_weights))
+                batch_pixels = []
+                batch_weights = []
+                batch_size = 0
+
+    if batch_size > 0:
+        add_pixels(hist, np.concatenate(batch_pixels), np.concatenate(batch_weights))
+
+
+def accumulate_edges(path, width, height):
+    hist = np.zeros((height, width))
+    columns = [ 'lender_lat', 'lender_lon', 'loan_lat', 'loan_lon', 'count' ]
+    for lat1, lon1, lat2, lon2, counts in read_csv_chunks(path, columns, EDGES_PER_CHUNK):
+        add_arcs(hist, lat1, lon1, lat2, lon2, counts)
+    return hist
+
+
+def accumulate_points(path, width, height):
+    hist = np.zeros((height, width))
+    for lat, lon, counts in read_csv_chunks(path, [ 'lat', 'lon', 'count' ], EDGES_PER_CHUNK):
+        add_points(hist, lat, lon, counts)
+    return hist
+
+
+#####################################################################
+#
+# Image Functions
+#
+#####################################################################
+
+def parse_color(color):
+    return np.array([ int(color[i:i + 2], 16) for i in (1, 3, 5) ], dtype=np.float64)
+
+
+def tone_map(hist, heatmap_cfg):
+    max_value = hist.max()
+    if max_value <= 0:
+        return hist
+    if heatmap_cfg.get('toneMapping', DEFAULT_TONE_MAPPING) == 'gamma':
+        return (hist / max_value) ** heatmap_cfg.get('gamma', DEFAULT_GAMMA)
+    return np.log1p(hist) / np.log1p(max_value)
+
+
+def dilate(values, radius):
+    # Grows every point into a square of the given radius, keeping the max value.
+    result = values.copy()
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            result = np.maximum(result, np.roll(np.roll(values, dy, axis=0), dx, axis=1))
+    return result
+
+
+def composite(image, values, palette_cfg):
+    # Values of 0 are transparent; otherwise they pick a color between
+    # the darkest and lightest colors of the palette.
+    darkest = parse_color(palette_cfg['darkestColor'])
+    lightest = parse_color(palette_cfg['lightestColor'])
+    alpha = values[..., np.newaxis]
+    colors = darkest + alpha * (lightest - darkest)
+    return image * (1 - alpha) + colors * alpha
+
+
+def write_png(path, image):
+    # Writes an 8-bit RGB png, so that drawing doesn't depend on an image library.
+    height, width = image.shape[:2]
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = np.clip(np.round(image), 0, 255).astype(np.uint8).reshape(height, width * 3)
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    file = open(path, 'wb')
+    file.write('\x89PNG\r\n\x1a\n')
+    file.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+    file.write(chunk('IDAT', zlib.compress(rows.tostring(), 6)))
+    file.write(chunk('IEND', ''))
+    file.close()
+
+
+def draw_image(cfg, edge_hist, lender_hist, loan_hist):
+    heatmap_cfg = cfg.get('heatmap', {})
+    image = np.empty(edge_hist.shape + (3,))
+    image[:] = parse_color(cfg['backgroundColor'])
+
+    image = composite(image, tone_map(edge_hist, heatmap_cfg), cfg['lenderLoanLines'])
+    for hist, palette_cfg in [ (lender_hist, cfg['lenderPoints']), (loan_hist, cfg['loanPoints']) ]:
+        radius = max(0, int(round(palette_cfg.get('size', 1) * 2)) - 1)
+        image = composite(image, dilate(tone_map(hist, heatmap_cfg), radius), palette_cfg)
+    return image
+
+
+#####################################################################
+#
+# Main + Other Functions
+#
+#####################################################################
+
+def read_cfg(path = 'custom_cfg.json'):
+    file = open(path, 'r')
+    cfg = json.loads(file.read())
+    file.close()
+    return cfg
+
+
+def render_heatmap(lender_loans_path, lenders_path, loans_path, image_path, cfg):
+    width = cfg['imgWidth']
+    height = cfg['imgHeight']
+    edge_hist = accumulate_edges(lender_loans_path, width, height)
+    lender_hist = accumulate_points(lenders_path, width, height)
+    loan_hist = accumulate_points(loans_path, width, height)
+    write_png(image_path, draw_image(cfg, edge_hist, lender_hist, loan_hist))
+
+
+def main(*args):
+    if len(args) < 5:
+        print 'Usage: ' + args[0] + ' <lender-loans csv> <lenders csv> <loans csv> <png> [cfg]'
+        return 0
+
+    cfg = read_cfg(args[5] if len(args) > 5 else 'custom_cfg.json')
+    print 'Drawing the heatmap to {0}...'.format(args[4])
+    render_heatmap(args[1], args[2], args[3], args[4], cfg)
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
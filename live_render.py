@@ -0,0 +1,87 @@
+import  sys, os, time
+import  numpy as np
+import  heatmap, animate
+from    coordinates import COORDINATE_SCALE
+from    live_state import attach_live_state, detach_live_state, live_state_replaced, read_live_state
+
+#####################################################################
+#
+#  This script draws the Kiva world map as a heatmap while
+#  process_loans.py is running with --live, from the data it
+#  publishes to live_state.bin (see live_state.py). It attaches to
+#  the file read-only, and whenever a new image has been published,
+#  copies it and draws it, so process_loans.py never waits for it. It
+#  attaches again when the file is replaced (by a new execution of
+#  process_loans.py) or has grown.
+#
+#  The lender and loan points are weighted by their lender-loans, as
+#  in animate.py.
+#
+#  To execute (from the directory process_loans.py is run in):
+#
+#  python live_render.py <png> [seconds] [cfg]
+#    Draws the latest image to <png> every [seconds] (default
+#    [RENDER_EVERY_SECONDS]); 0 draws it once and exits.
+#
+#####################################################################
+
+
+LIVE_STATE_PATH = 'live_state.bin'
+RENDER_EVERY_SECONDS = 60
+POINT_RECORD_DTYPE = np.dtype([ ('lat', '<i4'), ('lon', '<i4') ])
+
+
+def read_points(data):
+    # Returns the lat and lon arrays of the packed points, indexed by idx.
+    points = np.frombuffer(data, dtype=POINT_RECORD_DTYPE)
+    return points['lat'] / float(COORDINATE_SCALE), points['lon'] / float(COORDINATE_SCALE)
+
+
+def render_image(image, image_path, cfg):
+    shape = (cfg['imgHeight'], cfg['imgWidth'])
+    hists = (np.zeros(shape), np.zeros(shape), np.zeros(shape))
+    records = np.frombuffer(image['edges'], dtype=animate.EDGE_RECORD_DTYPE)
+    animate.add_bucket(hists, read_points(image['lenders']), read_points(image['loans']), records)
+
+    # The image is renamed into place, so it's never seen half written.
+    heatmap.write_png(image_path + '.tmp', heatmap.draw_image(cfg, *hists))
+    os.rename(image_path + '.tmp', image_path)
+
+
+def main(*args):
+    if len(args) < 2:
+        print 'Usage: ' + args[0] + ' <png> [seconds] [cfg]'
+        return 0
+
+    seconds = float(args[2]) if len(args) > 2 else RENDER_EVERY_SECONDS
+    cfg = heatmap.read_cfg(args[3] if len(args) > 3 else 'custom_cfg.json')
+
+    reader = None
+    last_version = None
+    while True:
+        if reader is not None and live_state_replaced(reader, LIVE_STATE_PATH):
+            detach_live_state(reader)
+            reader = None
+        if reader is None:
+            reader = attach_live_state(LIVE_STATE_PATH)
+            if reader is None:
+                print 'Waiting for process_loans.py --live to publish to {0}...'.format(LIVE_STATE_PATH)
+
+        image = read_live_state(reader, last_version) if reader is not None else None
+        if image is not None:
+            render_image(image, args[1], cfg)
+            last_version = image['version']
+            print 'Drew image {0} ({1} lenders, {2} loans and {3} lender-loans, published {4}) to {5}.'.format(
+                image['version'], image['num_lenders'], image['num_loans'], image['num_edges'],
+                time.strftime('%H:%M:%S', time.localtime(image['time'])), args[1])
+
+        if seconds <= 0:
+            break
+        time.sleep(seconds)
+
+    if reader is not None:
+        detach_live_state(reader)
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -0,0 +1,345 @@
+import  os, mmap, struct, time
+
+#####################################################################
+#
+#  This module shares the aggregation state of process_loans.py
+#  (the lender and loan points and the lender-loans) with other
+#  processes while it runs, through a memory-mapped file
+#  (live_state.bin), so live_render.py can draw the map without
+#  waiting for the csv files or reading them.
+#
+#  The file starts with a header:
+#   - magic and format version ([LIVE_STATE_VERSION])
+#   - seq: incremented when an image starts being written and again
+#     when it's published, so it's odd while one is being written
+#   - active: the slot of the published image, and the time it was
+#     published
+#   - the offset and capacity of the 2 slots
+#  followed by the slots and the point regions. An image is an image
+#  header (the number of lenders and loans, the offsets of their
+#  point regions, and the number of lender-loans) and the lender-loans
+#  as packed int32 (lender idx, loan idx, count) records. A
+#  lender-loan can appear more than once in an image; its counts add
+#  up. The points are packed int32 (lat, lon) records (by idx, with
+#  the coordinates of coordinates.py) in 2 regions, one for the
+#  lenders and one for the loans, which are shared by the images:
+#  points never change, so new ones are only appended after the ones
+#  the published image has.
+#
+#  The writer always writes the slot that isn't published, so readers
+#  never wait and are never waited on: a reader copies the published
+#  image, and checks seq afterwards to make sure the writer didn't
+#  start writing over that slot in the meantime (which it can only do
+#  after publishing another image). If an image or a point region
+#  doesn't fit, it's moved to the end of the file, with twice the
+#  capacity, so what a reader is copying is never written over.
+#
+#  An image is either written in full, or as the last image plus the
+#  lender-loans added since (a delta image). The slot of a delta image
+#  already holds an older image, so it only needs the deltas it's
+#  missing appended to it (or, after a full image, a copy of that
+#  image), which keeps publishing proportional to what has changed.
+#
+#####################################################################
+
+
+LIVE_STATE_MAGIC = 'KIVALIVE'
+LIVE_STATE_VERSION = 2
+HEADER = struct.Struct('<8sIIQdQQQQ')
+IMAGE_HEADER = struct.Struct('<IIQQQ')
+RECORD = struct.Struct('<iii')
+POINT = struct.Struct('<ii')
+ACTIVE = struct.Struct('<I')
+PUBLISH_TIME = struct.Struct('<d')
+SEQ = struct.Struct('<Q')
+SLOT = struct.Struct('<QQ')
+ACTIVE_OFFSET = 12
+SEQ_OFFSET = 16
+PUBLISH_TIME_OFFSET = 24
+SLOTS_OFFSET = 32
+LENDER_POINTS = 0
+LOAN_POINTS = 1
+RECORDS_PER_WRITE = 4096
+MIN_SLOT_BYTES = 1024 * 1024
+MAX_READ_ATTEMPTS = 100
+READ_RETRY_SECONDS = 0.05
+
+
+def read_slot(mm, slot):
+    return SLOT.unpack_from(mm, SLOTS_OFFSET + slot * SLOT.size)
+
+
+def image_size(mm, offset):
+    num_lenders, num_loans, lenders_offset, loans_offset, num_edges = IMAGE_HEADER.unpack_from(mm, offset)
+    return IMAGE_HEADER.size + num_edges * RECORD.size
+
+
+def is_live_state(mm):
+    return len(mm) >= HEADER.size and mm[:len(LIVE_STATE_MAGIC)] == LIVE_STATE_MAGIC and \
+           struct.unpack_from('<I', mm, len(LIVE_STATE_MAGIC))[0] == LIVE_STATE_VERSION
+
+
+#####################################################################
+#
+# Writer Functions
+#
+#####################################################################
+
+def create_live_state(path, seq = 0):
+    # The new file replaces any other one by renaming, so readers that had
+    # the other one mapped don't see it change under them.
+    file = open(path + '.tmp', 'wb')
+    file.write(HEADER.pack(LIVE_STATE_MAGIC, LIVE_STATE_VERSION, 0, seq, 0.0, HEADER.size, 0, HEADER.size, 0))
+    file.close()
+    os.rename(path + '.tmp', path)
+
+
+def open_live_state(path):
+    # Opens a new live state for writing. The seq of the last one carries on, rounded up
+    # to even (it's left odd if its writer stopped while writing an image), so that the
+    # versions seen by its readers keep increasing.
+    seq = 0
+    try:
+        file = open(path, 'rb')
+        header = file.read(HEADER.size)
+        file.close()
+        if is_live_state(header):
+            seq = SEQ.unpack_from(header, SEQ_OFFSET)[0]
+            seq += seq % 2
+    except IOError:
+        pass
+    create_live_state(path, seq)
+
+    file = open(path, 'r+b')
+    return {
+        'file': file,
+        'mm': mmap.mmap(file.fileno(), 0),
+        'points': [ { 'offset': 0, 'capacity': 0, 'count': 0 }, { 'offset': 0, 'capacity': 0, 'count': 0 } ],
+        # The packed lender-loans each slot is missing compared to the published image,
+        # or None if it has to copy the published image.
+        'behind': [ None, None ]
+    }
+
+
+def close_live_state(live):
+    live['mm'].flush()
+    live['mm'].close()
+    live['file'].close()
+
+
+def grow(mm, offset, num_bytes, capacity, needed):
+    # Moves the first [num_bytes] of a region to the end of the file, with room for [needed] bytes.
+    new_offset = len(mm)
+    new_capacity = max(MIN_SLOT_BYTES, capacity * 2, needed)
+    mm.resize(new_offset + new_capacity)
+    if num_bytes > 0:
+        mm.move(new_offset, offset, num_bytes)
+    return new_offset, new_capacity
+
+
+def begin_image(live):
+    # Starts writing an image in full, in the slot that isn't published.
+    mm = live['mm']
+    SEQ.pack_into(mm, SEQ_OFFSET, SEQ.unpack_from(mm, SEQ_OFFSET)[0] + 1)
+    return {
+        'live': live,
+        'slot': 1 - ACTIVE.unpack_from(mm, ACTIVE_OFFSET)[0],
+        'pos': IMAGE_HEADER.size,
+        'num_edges': 0,
+        'delta_pos': None
+    }
+
+
+def begin_delta_image(live):
+    # Starts writing an image as the published one plus the lender-loans written
+    # to it before it's committed.
+    image = begin_image(live)
+    mm = live['mm']
+    behind = live['behind'][image['slot']]
+    offset, capacity = read_slot(mm, image['slot'])
+    if behind is None or capacity == 0:
+        copy_published_edges(image)
+    else:
+        image['num_edges'] = IMAGE_HEADER.unpack_from(mm, offset)[4]
+        image['pos'] += image['num_edges'] * RECORD.size
+        write_data(image, behind, len(behind) / RECORD.size)
+    image['delta_pos'] = image['pos']
+    return image
+
+
+def reserve(image, num_bytes):
+    # Returns the offset of the image's slot, moving it if there isn't room for [num_bytes] more.
+    mm = image['live']['mm']
+    offset, capacity = read_slot(mm, image['slot'])
+    if image['pos'] + num_bytes <= capacity:
+        return offset
+
+    offset, capacity = grow(mm, offset, image['pos'], capacity, image['pos'] + num_bytes)
+    SLOT.pack_into(mm, SLOTS_OFFSET + image['slot'] * SLOT.size, offset, capacity)
+    return offset
+
+
+def write_data(image, data, num_edges):
+    offset = reserve(image, len(data))
+    image['live']['mm'][offset + image['pos']:offset + image['pos'] + len(data)] = data
+    image['pos'] += len(data)
+    image['num_edges'] += num_edges
+
+
+def copy_published_edges(image):
+    # Copies the lender-loans of the published image into this one.
+    mm = image['live']['mm']
+    src_offset, src_capacity = read_slot(mm, 1 - image['slot'])
+    if src_capacity == 0:
+        return
+    num_edges = IMAGE_HEADER.unpack_from(mm, src_offset)[4]
+
+    num_bytes = num_edges * RECORD.size
+    offset = reserve(image, num_bytes)
+    mm.move(offset + image['pos'], src_offset + IMAGE_HEADER.size, num_bytes)
+    image['pos'] += num_bytes
+    image['num_edges'] += num_edges
+
+
+def write_image_points(image, kind, points):
+    # Appends the new (lat, lon) points of [kind] (LENDER_POINTS or LOAN_POINTS), in idx order.
+    mm = image['live']['mm']
+    region = image['live']['points'][kind]
+    data = ''.join([ POINT.pack(*point) for point in points ])
+    end = region['count'] * POINT.size
+    if end + len(data) > region['capacity']:
+        region['offset'], region['capacity'] = grow(mm, region['offset'], end, region['capacity'], end + len(data))
+    mm[region['offset'] + end:region['offset'] + end + len(data)] = data
+    region['count'] += len(points)
+
+
+def write_image_edges(image, edges):
+    chunk = []
+    for edge in edges:
+        chunk.append(edge)
+        if len(chunk) == RECORDS_PER_WRITE:
+            write_data(image, ''.join([ RECORD.pack(*record) for record in chunk ]), len(chunk))
+            chunk = []
+    write_data(image, ''.join([ RECORD.pack(*record) for record in chunk ]), len(chunk))
+
+
+def tee_image_edges(image, edges):
+    # Yields the edges, writing them to the image as they go by.
+    chunk = []
+    for edge in edges:
+        chunk.append(edge)
+        if len(chunk) == RECORDS_PER_WRITE:
+            write_image_edges(image, chunk)
+            chunk = []
+        yield edge
+    write_image_edges(image, chunk)
+
+
+def commit_image(image):
+    live = image['live']
+    mm = live['mm']
+    offset = reserve(image, 0)
+    lenders, loans = live['points']
+    IMAGE_HEADER.pack_into(mm, offset, lenders['count'], loans['count'], lenders['offset'], loans['offset'], image['num_edges'])
+    PUBLISH_TIME.pack_into(mm, PUBLISH_TIME_OFFSET, time.time())
+    ACTIVE.pack_into(mm, ACTIVE_OFFSET, image['slot'])
+    SEQ.pack_into(mm, SEQ_OFFSET, SEQ.unpack_from(mm, SEQ_OFFSET)[0] + 1)
+
+    # The slot that was published is now missing this image's deltas, or all of it.
+    live['behind'][image['slot']] = ''
+    if image['delta_pos'] is None:
+        live['behind'][1 - image['slot']] = None
+    else:
+        live['behind'][1 - image['slot']] = mm[offset + image['delta_pos']:offset + image['pos']]
+
+
+#####################################################################
+#
+# Reader Functions
+#
+#####################################################################
+
+def attach_live_state(path):
+    # Attaches to the live state read-only; returns None if there isn't a valid one.
+    try:
+        file = open(path, 'rb')
+    except IOError:
+        return None
+    mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if not is_live_state(mm):
+        mm.close()
+        file.close()
+        return None
+    return { 'file': file, 'mm': mm }
+
+
+def detach_live_state(reader):
+    reader['mm'].close()
+    reader['file'].close()
+
+
+def live_state_replaced(reader, path):
+    # Returns whether the file at [path] isn't the one attached to (a writer started
+    # since replaces it), or has grown since it was mapped.
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_ino != os.fstat(reader['file'].fileno()).st_ino or stat.st_size != len(reader['mm'])
+
+
+def read_live_state(reader, last_version = None):
+    # Returns a copy of the published image (its version, publish time, counts, and the packed
+    # lenders, loans and lender-loans), or None if no image newer than [last_version] has
+    # been published.
+    for attempt in xrange(MAX_READ_ATTEMPTS):
+        mm = reader['mm']
+        seq = SEQ.unpack_from(mm, SEQ_OFFSET)[0]
+        if seq % 2 == 1:
+            # An image is being written.
+            time.sleep(READ_RETRY_SECONDS)
+            continue
+
+        version = seq / 2
+        if version == last_version:
+            return None
+
+        slot = ACTIVE.unpack_from(mm, ACTIVE_OFFSET)[0]
+        publish_time = PUBLISH_TIME.unpack_from(mm, PUBLISH_TIME_OFFSET)[0]
+        offset, capacity = read_slot(mm, slot)
+        if capacity == 0:
+            return None
+        if offset + capacity > len(mm):
+            # The writer has grown the file since it was mapped.
+            reader['mm'] = mmap.mmap(reader['file'].fileno(), 0, access=mmap.ACCESS_READ)
+            mm.close()
+            continue
+
+        num_lenders, num_loans, lenders_offset, loans_offset, num_edges = IMAGE_HEADER.unpack_from(mm, offset)
+        edges = mm[offset + IMAGE_HEADER.size:offset + IMAGE_HEADER.size + num_edges * RECORD.size]
+        lenders = mm[lenders_offset:lenders_offset + num_lenders * POINT.size]
+        loans = mm[loans_offset:loans_offset + num_loans * POINT.size]
+
+        # The slot is only written over once the writer has published another image
+        # and started the next one.
+        if SEQ.unpack_from(mm, SEQ_OFFSET)[0] > seq + 2:
+            time.sleep(READ_RETRY_SECONDS)
+            continue
+        if len(lenders) != num_lenders * POINT.size or len(loans) != num_loans * POINT.size:
+            # A point region was grown since the file was mapped.
+            reader['mm'] = mmap.mmap(reader['file'].fileno(), 0, access=mmap.ACCESS_READ)
+            mm.close()
+            continue
+
+        return {
+            'version': version,
+            'time': publish_time,
+            'num_lenders': num_lenders,
+            'num_loans': num_loans,
+            'num_edges': num_edges,
+            'lenders': lenders,
+            'loans': loans,
+            'edges': edges
+        }
+
+    return None
@@ -0,0 +1,103 @@
+import  json, re, unicodedata
+
+#####################################################################
+#
+#  This module turns the location strings of Kiva lenders into the
+#  canonical keys used by the location caches of both
+#  process_loans.py and generate_custom_map.py, so the same place
+#  is only geocoded once no matter how its lender typed it.
+#
+#  A canonical key is the lender's whereabouts followed by the
+#  country code, e.g. "saint louis, mo, US":
+#   - Unicode is NFKC normalized and lower-cased
+#   - URLs (kivafriends.org in particular) are removed
+#   - apostrophes, and the periods of initialisms (e.g. "n.y.c."),
+#     are dropped and other punctuation (including other periods,
+#     e.g. "st.louis") becomes whitespace
+#   - whitespace is collapsed and empty comma-separated parts are
+#     dropped
+#   - the last part is upper-cased if it is a country code
+#
+#  [aliases] maps raw strings to canonical keys. It remembers every
+#  string that has been normalized, and can be seeded from a file
+#  of manual aliases (see load_aliases) to merge keys that the
+#  rules above can't, e.g. "nyc, US" -> "new york, US".
+#
+#####################################################################
+
+
+ALIASES_FILE_NAME = 'location_aliases.json'
+
+JUNK_RE = re.compile(r'(https?://)?(www\.)?kivafriends\.org/?|https?://\S+|www\.\S+', re.UNICODE)
+DROPPED_PUNCTUATION_RE = re.compile(u"['`\u2019]", re.UNICODE)
+INITIALISM_RE = re.compile(r'\b[^\W\d_](\.[^\W\d_])+\b\.?', re.UNICODE)
+PUNCTUATION_RE = re.compile(r'[^\w\s,]|_', re.UNICODE)
+WHITESPACE_RE = re.compile(r'\s+', re.UNICODE)
+COUNTRY_CODE_RE = re.compile(r'^[a-z]{2}$')
+
+aliases = {}
+
+
+def canonicalize(raw):
+    if isinstance(raw, str):
+        raw = unicode(raw, 'utf-8', 'replace')
+
+    loc_str = unicodedata.normalize('NFKC', raw).lower()
+    loc_str = JUNK_RE.sub(' ', loc_str)
+    loc_str = DROPPED_PUNCTUATION_RE.sub('', loc_str)
+    loc_str = INITIALISM_RE.sub(lambda match: match.group(0).replace('.', ''), loc_str)
+    loc_str = PUNCTUATION_RE.sub(' ', loc_str)
+
+    parts = []
+    for part in loc_str.split(','):
+        part = WHITESPACE_RE.sub(' ', part).strip()
+        if len(part) > 0:
+            parts.append(part)
+
+    if len(parts) > 1 and COUNTRY_CODE_RE.match(parts[-1]):
+        parts[-1] = parts[-1].upper()
+
+    return u', '.join(parts)
+
+
+def canonical_key(raw):
+    if raw in aliases:
+        return aliases[raw]
+
+    key = canonicalize(raw)
+    key = aliases.get(key, key)
+    aliases[raw] = key
+    return key
+
+
+def normalize_location(whereabouts, country_code = None):
+    loc_str = whereabouts
+    if country_code:
+        loc_str += u', ' + country_code
+    return canonical_key(loc_str)
+
+
+def load_aliases(path = ALIASES_FILE_NAME):
+    # The file holds a map of raw string -> location string; both sides
+    # are canonicalized, so the aliases don't need to be written exactly.
+    try:
+        file = open(path, 'r')
+        manual_aliases = json.loads(file.read())
+        file.close()
+    except IOError:
+        return
+
+    for raw, loc_str in manual_aliases.iteritems():
+        aliases[canonicalize(raw)] = canonicalize(loc_str)
+
+
+def migrate_locations(cached_locations):
+    # Re-keys a location cache that was saved before its keys were canonical.
+    # When several keys collapse into one, a valid location wins over an
+    # invalid one (-1).
+    migrated = {}
+    for loc_str, location in cached_locations.iteritems():
+        key = canonical_key(loc_str)
+        if key not in migrated or migrated[key] == -1:
+            migrated[key] = location
+    return migrated
@@ -0,0 +1,139 @@
+import  sys, json, time, threading, Queue, atexit
+
+#####################################################################
+#
+#  This module writes the logs of process_loans.py and
+#  generate_custom_map.py, without slowing down the loops that log.
+#
+#  A record is a JSON object on its own line, with the time, level
+#  ('error', 'warning' or 'summary'), category, message, data and
+#  traceback (for errors). write_record() only queues the record;
+#  a background thread formats it and writes it to the (buffered)
+#  log file, which is flushed every [FLUSH_EVERY_SECONDS] and when
+#  the log is closed.
+#
+#  So that a bad file can't flood the log:
+#   - the data of a record is cut to [MAX_DATA_CHARS] characters
+#   - each category logs at most [RECORDS_PER_WINDOW] records every
+#     [WINDOW_SECONDS]; the rest are counted, and a summary record
+#     with the count is written when the window ends (or the log is
+#     closed)
+#
+#####################################################################
+
+
+MAX_DATA_CHARS = 2000
+RECORDS_PER_WINDOW = 20
+WINDOW_SECONDS = 60
+FLUSH_EVERY_SECONDS = 5
+FILE_BUFFER_BYTES = 64 * 1024
+
+# [log] holds the open log file, the queue of records to write, the writer
+# thread, and the rate limit windows (map of category -> window start time,
+# number of records logged and number suppressed).
+log = { 'file': None, 'queue': None, 'thread': None, 'windows': {} }
+
+
+def format_data(data):
+    if not isinstance(data, basestring):
+        try:
+            data = json.dumps(data, default=repr)
+        except (TypeError, ValueError):
+            data = repr(data)
+    if len(data) > MAX_DATA_CHARS:
+        data = u'{0}... ({1} more characters)'.format(data[:MAX_DATA_CHARS], len(data) - MAX_DATA_CHARS)
+    return data
+
+
+def format_record(record):
+    if 'data' in record:
+        record['data'] = format_data(record['data'])
+    record['time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['time']))
+    return json.dumps(record) + '\n'
+
+
+def write_records():
+    # Runs in the writer thread, until it's sent None.
+    last_flush = time.time()
+    while True:
+        try:
+            record = log['queue'].get(True, FLUSH_EVERY_SECONDS)
+        except Queue.Empty:
+            record = False
+
+        if record is None:
+            break
+        if record:
+            try:
+                log['file'].write(format_record(record))
+            except Exception, e:
+                log['file'].write(json.dumps({ 'level': 'error', 'category': 'log', 'message': u'Could not write a record: {0}'.format(e) }) + '\n')
+
+        if time.time() - last_flush >= FLUSH_EVERY_SECONDS:
+            log['file'].flush()
+            last_flush = time.time()
+
+    log['file'].flush()
+
+
+def summary_record(category, window):
+    return {
+        'time': time.time(),
+        'level': 'summary',
+        'category': category,
+        'message': u'{0} more {1} record(s) were not logged'.format(window['suppressed'], category)
+    }
+
+
+def allow_record(category):
+    # Returns whether the category may log another record in its window.
+    now = time.time()
+    window = log['windows'].get(category)
+    if window is None or now - window['start'] >= WINDOW_SECONDS:
+        if window is not None and window['suppressed'] > 0:
+            log['queue'].put(summary_record(category, window))
+        window = { 'start': now, 'logged': 0, 'suppressed': 0 }
+        log['windows'][category] = window
+
+    if window['logged'] >= RECORDS_PER_WINDOW:
+        window['suppressed'] += 1
+        return False
+    window['logged'] += 1
+    return True
+
+
+def write_record(level, category, message, data = None, traceback_str = None):
+    if log['queue'] is None or not allow_record(category):
+        return
+
+    record = { 'time': time.time(), 'level': level, 'category': category, 'message': message }
+    if data is not None and data != '':
+        record['data'] = data
+    if traceback_str is not None:
+        record['traceback'] = traceback_str
+    log['queue'].put(record)
+
+
+def open_log(path):
+    log['file'] = open(path, 'wb', FILE_BUFFER_BYTES)
+    log['queue'] = Queue.Queue()
+    log['windows'] = {}
+    log['thread'] = threading.Thread(target=write_records)
+    log['thread'].daemon = True
+    log['thread'].start()
+
+    # The log is also closed if the script exits without closing it.
+    atexit.register(close_log)
+
+
+def close_log():
+    if log['queue'] is None:
+        return
+
+    for category, window in log['windows'].iteritems():
+        if window['suppressed'] > 0:
+            log['queue'].put(summary_record(category, window))
+    log['queue'].put(None)
+    log['thread'].join()
+    log['file'].close()
+    log['queue'] = None
@@ -0,0 +1,223 @@
+import  sys, os, json, csv, zlib, tempfile, shutil
+from    coordinates import to_fixed, format_fixed, pack_point, unpack_point
+from    generate_custom_map import point_distance, open_for_replace, finish_replace
+
+#####################################################################
+#
+#  This script combines the data of several custom maps (made by
+#  generate_custom_map.py) into the data of a new custom map, e.g. to
+#  draw a map for a group of lending teams without fetching all of
+#  their data again.
+#
+#  To execute:
+#
+#  python merge_custom_maps.py <A> <B> <B> ...
+#    A: The ID of the combined map, e.g. m_teams
+#    B: The IDs of the maps to combine, e.g. t_buildkiva l_seand
+#
+#  The combined map is written to data/<A>_*.csv, and can be drawn
+#  with: Rscript draw_custom_map.R --args <A>
+#
+#####################################################################
+#
+#  Implementation Details
+#
+#  Loans shared by several maps (and lenders in several teams) must
+#  only be counted once, so the maps are combined from the records
+#  in their data/<id>_processed_loans.json (the point of each loan
+#  and the uid -> point of its lenders in that map):
+#   - the records of every map are streamed into [MERGE_PARTITIONS]
+#     temporary files, partitioned by loan id, so all the records of
+#     a loan end up in the same partition
+#   - each partition is read into memory on its own, and the lenders
+#     of every loan are combined; then each loan counts once for its
+#     point and each (lender, loan) once for its lender-loan (loans
+#     without any lenders in the maps aren't counted, as in
+#     generate_custom_map.py)
+#   - a lender point counts the distinct lenders at that point who
+#     lent to at least one of the combined loans; unlike the counts of
+#     the maps being combined (e.g. a lender's loan count, or a team's
+#     members), lenders without any loans in the maps aren't counted
+#
+#  So the memory used is that of the largest map's records, or of
+#  one partition, plus the combined map itself.
+#
+#  Maps processed before the records were kept (their loans map to
+#  1) can't be deduplicated; their csv counts are added as they are,
+#  with a warning.
+#
+#####################################################################
+
+
+MERGE_PARTITIONS = 64
+
+
+def read_processed_loans(id):
+    try:
+        file = open('data/{0}_processed_loans.json'.format(id), 'r')
+        processed_loans = json.loads(file.read())
+        file.close()
+        return processed_loans
+    except IOError:
+        return None
+
+
+def read_counts(path, num_point_columns):
+    # Yields the point(s) and count of every row of a custom map csv file.
+    file = open(path, 'r')
+    reader = csv.reader(file, delimiter=';')
+    header = reader.next()
+    count_column = header.index('count')
+    for row in reader:
+        points = []
+        for i in xrange(0, num_point_columns * 2, 2):
+            points.append(pack_point(to_fixed(row[i]), to_fixed(row[i + 1])))
+        yield tuple(points), int(row[count_column])
+    file.close()
+
+
+def partition_records(ids, partition_dir, merged):
+    partitions = [ open(os.path.join(partition_dir, '{0}.txt'.format(i)), 'wb') for i in xrange(MERGE_PARTITIONS) ]
+    for id in ids:
+        processed_loans = read_processed_loans(id)
+        if processed_loans is None:
+            print u'Warning: {0} has no data (data/{0}_processed_loans.json), so it is skipped.'.format(id)
+            continue
+        if any(not isinstance(record, dict) for record in processed_loans.itervalues()):
+            print u'Warning: {0} has loans processed before loan records were kept, so its counts are added as they are (loans shared with the other maps are counted twice).'.format(id)
+            add_csv_counts(id, merged)
+            continue
+
+        print u'Partitioning the {0} loans of {1}...'.format(len(processed_loans), id)
+        for loan_id, record in processed_loans.iteritems():
+            loan_id = loan_id.encode('utf-8')
+            partition = partitions[(zlib.crc32(loan_id) & 0xffffffff) % MERGE_PARTITIONS]
+            partition.write('{0}\t{1}\n'.format(loan_id, json.dumps(record)))
+
+    for partition in partitions:
+        partition.close()
+
+
+def add_csv_counts(id, merged):
+    for (lender_loc,), count in read_counts('data/{0}_lenders.csv'.format(id), 1):
+        merged['lender_counts'][lender_loc] = merged['lender_counts'].get(lender_loc, 0) + count
+    for (loan_loc,), count in read_counts('data/{0}_loans.csv'.format(id), 1):
+        merged['loan_locations'][loan_loc] = merged['loan_locations'].get(loan_loc, 0) + count
+    for edge, count in read_counts('data/{0}_lender_loans.csv'.format(id), 2):
+        merged['lender_loans'][edge] = merged['lender_loans'].get(edge, 0) + count
+
+
+def merge_partition(path, merged, processed_loans_file):
+    # Combines the records of every loan in the partition.
+    records = {}
+    file = open(path, 'r')
+    for line in file:
+        loan_id, sep, record_json = line.rstrip('\n').partition('\t')
+        record = json.loads(record_json)
+        if loan_id not in records:
+            records[loan_id] = record
+        else:
+            records[loan_id]['lenders'].update(record['lenders'])
+    file.close()
+
+    for loan_id, record in records.iteritems():
+        # The record is kept, but a loan without lenders isn't drawn.
+        loan_loc = record['location']
+        if len(record['lenders']) > 0:
+            merged['loan_locations'][loan_loc] = merged['loan_locations'].get(loan_loc, 0) + 1
+        for uid, lender_loc in record['lenders'].iteritems():
+            merged['lender_uids'][uid] = lender_loc
+            edge = (lender_loc, loan_loc)
+            merged['lender_loans'][edge] = merged['lender_loans'].get(edge, 0) + 1
+
+        if merged['num_loans'] > 0:
+            processed_loans_file.write(',')
+        processed_loans_file.write('{0}:{1}'.format(json.dumps(loan_id), json.dumps(record)))
+        merged['num_loans'] += 1
+
+
+def write_counts(path, counts):
+    file = open_for_replace(path)
+    writer = csv.writer(file, delimiter=';')
+    writer.writerow([ 'lat', 'lon', 'count' ])
+    for point, count in sorted(counts.iteritems()):
+        lat, lon = unpack_point(point)
+        writer.writerow([ format_fixed(lat), format_fixed(lon), count ])
+    finish_replace(file, path)
+
+
+def write_lender_loans(path, lender_loans):
+    file = open_for_replace(path)
+    writer = csv.writer(file, delimiter=';')
+    writer.writerow(['lender_lat', 'lender_lon', 'loan_lat', 'loan_lon', 'distance', 'count'])
+    for (lender_loc, loan_loc), count in sorted(lender_loans.iteritems()):
+        lender_lat, lender_lon = unpack_point(lender_loc)
+        loan_lat, loan_lon = unpack_point(loan_loc)
+        writer.writerow([
+            format_fixed(lender_lat),
+            format_fixed(lender_lon),
+            format_fixed(loan_lat),
+            format_fixed(loan_lon),
+            point_distance(lender_loc, loan_loc),
+            count
+        ])
+    finish_replace(file, path)
+
+
+def merge_maps(merged_id, ids):
+    merged = {
+        'lender_counts': {},
+        'lender_uids': {},
+        'loan_locations': {},
+        'lender_loans': {},
+        'num_loans': 0
+    }
+
+    partition_dir = tempfile.mkdtemp(prefix='merge_', dir='data')
+    try:
+        partition_records(ids, partition_dir, merged)
+
+        # The combined records are written as they're merged, so the combined
+        # map can itself be merged later.
+        path = 'data/{0}_processed_loans.json'.format(merged_id)
+        processed_loans_file = open_for_replace(path)
+        processed_loans_file.write('{')
+        for i in xrange(MERGE_PARTITIONS):
+            merge_partition(os.path.join(partition_dir, '{0}.txt'.format(i)), merged, processed_loans_file)
+        processed_loans_file.write('}')
+        finish_replace(processed_loans_file, path)
+    finally:
+        shutil.rmtree(partition_dir)
+
+    lender_counts = merged['lender_counts']
+    for lender_loc in merged['lender_uids'].itervalues():
+        lender_counts[lender_loc] = lender_counts.get(lender_loc, 0) + 1
+
+    write_counts('data/{0}_lenders.csv'.format(merged_id), lender_counts)
+    write_counts('data/{0}_loans.csv'.format(merged_id), merged['loan_locations'])
+    write_lender_loans('data/{0}_lender_loans.csv'.format(merged_id), merged['lender_loans'])
+    return merged
+
+
+def main(*args):
+    if len(args) < 3:
+        print '\n  Proper Usage:\n'
+        print '  ' + args[0] + ' A B B ...\n'
+        print '     A: The ID of the combined map'
+        print '     B: The IDs of the maps to combine (l_<lender id> or t_<team shortname>)'
+        print '\n  Example:\n'
+        print '     merge_custom_maps.py m_teams t_buildkiva t_kivafriends: combines the maps of 2 teams'
+        return 0
+
+    if args[1] in args[2:]:
+        print u'The combined map can\'t be one of the maps being combined.'
+        return 0
+
+    merged = merge_maps(args[1], args[2:])
+    print u'Combined {0} loans, {1} lender locations and {2} lender-loans into data/{3}_*.csv.'.format(
+        merged['num_loans'], len(merged['lender_counts']), len(merged['lender_loans']), args[1])
+    print u'Draw the map with: Rscript draw_custom_map.R --args {0}'.format(args[1])
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -1,17 +1,35 @@
-import  sys, traceback, urllib, json, csv, time
+import  sys, traceback, json, csv, os, struct, heapq, hashlib, time
 from    math import *
+from    location_normalizer import normalize_location, load_aliases, migrate_locations
+from    geocoders import geocode, NOT_FOUND
+from    rate_control import fetch
+from    log_writer import open_log, close_log, write_record
+from    live_state import open_live_state, close_live_state, begin_image, begin_delta_image, write_image_points, \
+                           write_image_edges, tee_image_edges, commit_image, LENDER_POINTS, LOAN_POINTS
+from    coordinates import to_fixed, to_degrees, format_fixed, pack_point, unpack_point, parse_point
 
 ###############################################################################################
 #  
 #  This script iterates the loans found in the Kiva data snapshot (which should be located
 #  in /loans with respect to this script), and for each one finds the lenders (using the
-#  Kiva API) and their locations (using the Google Maps API). It compiles this data into
+#  Kiva API) and their locations (using geocoders.py). It compiles this data into
 #  3 files:
 #   - lender_locations.csv
 #   - loan_locations.csv
 #   - lender_loans.csv
 #  
-#  To execute: python process_loans.py <number of loan files>
+#  To execute: python process_loans.py <number of loan files> [--edge-budget=<number of edges>]
+#    [--max-edges=<number of edges>] [--delta] [--live]
+#  
+#  --edge-budget: Aggregate the lender-loans out of core, keeping at most this many of them
+#    in memory (see below).
+#  --max-edges: Also write the lender-loans with the highest sortValue (see kiva.R) to
+#    lender_loans_top.csv, at most this many of them, sorted by sortValue. kiva.R draws these
+#    instead of all the lender-loans when the file exists.
+#  --delta: Process the loan files of a new snapshot that weren't in the snapshots processed
+#    before, instead of continuing from the next loan file (see below).
+#  --live: Publish the data to live_state.bin as it's processed, so live_render.py can draw it
+#    while this script runs (see below).
 #  
 ###############################################################################################
 #  
@@ -31,19 +49,22 @@ from    math import *
 #    2) the next loan file to process (key is 'file_num')
 #  
 #  locations: This is a map from location_string to location:
-#    - location_string: The 'whereabouts' and 'country_code' of a Kiva lender
+#    - location_string: The 'whereabouts' and 'country_code' of a Kiva lender,
+#        normalized by location_normalizer.py
 #    - location: format is '<lat> <lon>'
 #  
 #  loan_locations: This is a map from location to loan_info:
-#    - location: format is '<lat> <lon>'
-#    - loan_info: contains loan count, idx into idx_to_loan_map, lat, and lon
+#    - location: a lat/lon point packed into an int (see coordinates.py)
+#    - loan_info: contains loan count, idx into idx_to_loan_map, lat, and lon (as fixed-point
+#        ints, which are only formatted as decimals when written to the csv files)
 #  
 #  idx_to_loan_map: This is a map from idx to loan_info. Indices are used to uniquely 
 #    identify loans and lenders, so they can be persisted in files and then read back
-#    into memory on the subsequent executions of this script.
+#    into memory on the subsequent executions of this script. If 2 rows of a file have
+#    the same point, both indices map to the first one's loan_info.
 #  
 #  lender_locations: This is a map from location to lender_info:
-#    - location: format is '<lat> <lon>'
+#    - location: a lat/lon point packed into an int (see coordinates.py)
 #    - lender_info: contains lender count, idx into idx_to_lender_map, and a map which has
 #        structure as loan_locations; it contains lender-loan count, distance between lender
 #        and loan, and idx into idx_to_loan_map. This is done so that we can access the
@@ -52,6 +73,68 @@ from    math import *
 #  idx_to_lender_map: This is a map from idx to lender_info (same structure as loan_info).
 #  
 ###############################################################################################
+#  
+#  Out-of-core Aggregation
+#  
+#  Over the full snapshot, the lender-loans held in lender_locations grow larger than memory.
+#  When an edge budget is given, lender_loans.csv is never read into memory. Instead, once the
+#  number of lender-loans in memory reaches the budget, they are sorted by (lender idx, loan idx)
+#  and spilled to a run file in lender_loans_runs/ (as packed (lender idx, loan idx, count)
+#  records), and removed from memory.
+#  
+#  When the data is written, the runs and the existing lender_loans.csv (which is always
+#  written sorted in this mode) are k-way merged into the new lender_loans.csv, summing the
+#  counts of matching lender-loans.
+#  
+###############################################################################################
+#  
+#  Time Buckets
+#  
+#  Every lender-loan is also recorded in the time bucket of its loan: the month it was posted
+#  (or funded, if the snapshot doesn't have the posted date), e.g. '2006-04'. Each bucket is a
+#  file in buckets/ of packed (lender idx, loan idx, count) records, which are only ever
+#  appended to, and buckets/index.json holds the number of records and lender-loans of each
+#  bucket, along with the cumulative number of lender-loans up to and including it.
+#  
+#  Lender and loan indices never change, so animate.py can draw the frames of the map's
+#  growth by adding one bucket at a time to the previous frame.
+#  
+###############################################################################################
+#  
+#  Snapshot Diffs
+#  
+#  Every new Kiva snapshot renumbers its loan files, so the next file_num doesn't say which
+#  loans are left. Instead, with --delta, every loan file that is processed in full is
+#  fingerprinted in snapshot_manifest.json:
+#   - hashes: map of the SHA-1 of a file's contents -> the number of loans in it and the
+#       range of their ids
+#   - files: map of path -> size, modification time and hash, so the hash of a file is only
+#       computed again when it has changed
+#  With --delta, the files of the snapshot whose hash is in the manifest are skipped without
+#  being read, and only the loans in the other files that are new or have changed are
+#  processed.
+#  
+#  A loan can only gain lenders while it's fundraising, so the loans that were fundraising
+#  when they were processed are kept in fundraising_loans.json (map of loan id -> the status,
+#  funded amount and lender count of the loan, the lenders that were counted, and whether the
+#  loan was counted in loan_locations). When such a loan has changed in the snapshot, its
+#  lenders are fetched again and only the ones that weren't counted before are added.
+#  
+###############################################################################################
+#  
+#  Live State
+#  
+#  With --live, the lender and loan points and the lender-loans are published to
+#  live_state.bin (see live_state.py) whenever the data is written, and otherwise every
+#  [LIVE_PUBLISH_SECONDS] between loans, so the published data is always that of whole loans.
+#  
+#  Every lender-loan added is also counted in live_edges (map of (lender idx, loan idx) ->
+#  count), so between loans, only the new points and those lender-loans are published, on
+#  top of the last image. All the lender-loans are only written to the live state when they
+#  are written to lender_loans.csv (as they're merged, with an edge budget), which replaces
+#  the repeated lender-loans of the images before it.
+#  
+###############################################################################################
 
 
 # Initialize global variables.
@@ -62,19 +145,46 @@ lender_locations = {}
 idx_to_loan_map = {}
 loan_locations = {}
 
-SECONDS_BETWEEN_KIVA_QUERIES = 1
-SECONDS_BETWEEN_GMAPS_QUERIES = 1
+# Out-of-core aggregation variables (only used with an edge budget).
+options = { 'edge_budget': None, 'max_edges': None, 'delta': False, 'live': False }
+edge_runs = []
+num_edges_in_memory = 0
+merge_existing_edges = False
+
+# Time bucket variables: the lender-loans of every bucket that haven't been written yet
+# (map of bucket -> (lender idx, loan idx) -> count), and the bucket index.
+bucket_edges = {}
+bucket_index = {}
+
+# Snapshot diff variables: the loans that may still gain lenders, and the loan files processed.
+fundraising_loans = {}
+snapshot_manifest = { 'hashes': {}, 'files': {} }
+
+# Live state variables (only used with --live).
+live_state = None
+live_edges = {}
+last_live_publish = 0
+
 MAX_EXCEPTIONS_TOLERATED = 30
+EDGE_RUNS_DIR = 'lender_loans_runs'
+EDGE_RECORD = struct.Struct('<iii')
+EDGE_RECORDS_PER_READ = 4096
+TOP_EDGES_PATH = 'lender_loans_top.csv'
+DISTANCE_RANGE_NUM = 10
+BUCKETS_DIR = 'buckets'
+BUCKET_INDEX_PATH = os.path.join(BUCKETS_DIR, 'index.json')
+LOANS_DIR = 'loans'
+FUNDRAISING_LOANS_PATH = 'fundraising_loans.json'
+SNAPSHOT_MANIFEST_PATH = 'snapshot_manifest.json'
+HASH_BLOCK_BYTES = 1024 * 1024
+LIVE_STATE_PATH = 'live_state.bin'
+LIVE_PUBLISH_SECONDS = 30
 
 
-def log_exception(data_str, data = ''):
+def log_exception(data_str, data = '', category = 'error'):
     log_exception.num_errors_logged += 1
     
-    log_exception.log_file.write('-----------------------------------------------------------\n')
-    log_exception.log_file.write('Unexpected error processing {0}:\n{1}\n'.format(data_str, data))
-    log_exception.log_file.write('-----------------------------------------------------------\n')
-    traceback.print_exc(None, log_exception.log_file)
-    log_exception.log_file.write('-----------------------------------------------------------\n\n')
+    write_record('error', category, u'Unexpected error processing {0}'.format(data_str), data, traceback.format_exc())
     
     if(log_exception.num_errors_logged > MAX_EXCEPTIONS_TOLERATED):
         # Abort the program if the number of errors is too high.
@@ -82,19 +192,14 @@ def log_exception(data_str, data = ''):
         sys.exit()
 
 
-def log_warning(warning, data = ''):
+def log_warning(warning, data = '', category = 'warning'):
     log_warning.num_warnings_logged += 1
     
-    log_exception.log_file.write('-----------------------------------------------------------\n')
-    try:
-        log_exception.log_file.write(u'Warning: {0}\n{1}\n'.format(warning, data))
-    except UnicodeEncodeError:
-        log_exception.log_file.write(u'Exception when trying to display warning: {0}\n'.format(data))
-    log_exception.log_file.write('-----------------------------------------------------------\n\n')
+    write_record('warning', category, warning, data)
 
 
 def add_lender_location(loc_str, lat, lon):
-    lender_loc = '{0} {1}'.format(lat, lon)
+    lender_loc = pack_point(lat, lon)
     if lender_loc not in lender_locations:
         lender_idx = len(idx_to_lender_map)
         lender_locations[lender_loc] = {
@@ -108,10 +213,10 @@ def add_lender_location(loc_str, lat, lon):
     locations[loc_str] = lender_locations[lender_loc]['idx']
 
 
-def add_loan_location(lat, lon):
-    loan_loc = '{0} {1}'.format(lat, lon)
+def add_loan_location(loan_loc):
     if loan_loc not in loan_locations:
         loan_idx = len(idx_to_loan_map)
+        lat, lon = unpack_point(loan_loc)
         loan_locations[loan_loc] = {
             'idx': loan_idx,
             'count': 1,
@@ -130,7 +235,7 @@ def haversine(lat1, lon1, lat2, lon2):
     on the earth (specified in decimal degrees)
     """
     # convert decimal degrees to radians 
-    lon1, lat1, lon2, lat2 = map(radians, [float(lon1), float(lat1), float(lon2), float(lat2)])
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
     # haversine formula 
     dlon = lon2 - lon1 
     dlat = lat2 - lat1 
@@ -140,28 +245,302 @@ def haversine(lat1, lon1, lat2, lon2):
     return km
 
 
+def distance_between(lender_info, loan_info):
+    return haversine(to_degrees(lender_info['lat']), to_degrees(lender_info['lon']),
+                     to_degrees(loan_info['lat']), to_degrees(loan_info['lon']))
+
+
 def add_lender_loan(lender_idx, loan_loc):
     lender_info = idx_to_lender_map[lender_idx]
     lender_info['count'] += 1
     loan_locs_from_lender = lender_info['loan_locations']
     
-    loan_info = loan_locations[loan_loc]
-    distance = haversine(lender_info['lat'], lender_info['lon'], loan_info['lat'], loan_info['lon'])
+    if live_state is not None:
+        edge = (lender_info['idx'], loan_locations[loan_loc]['idx'])
+        live_edges[edge] = live_edges.get(edge, 0) + 1
     
     if loan_loc not in loan_locs_from_lender:
+        loan_info = loan_locations[loan_loc]
         loan_locs_from_lender[loan_loc] = {
-            'idx': loan_locations[loan_loc]['idx'],
+            'idx': loan_info['idx'],
             'lender_loan_count': 1,
-            'distance': distance,
+            'distance': distance_between(lender_info, loan_info),
             'lat': loan_info['lat'],
             'lon': loan_info['lon']
         }
+        
+        global num_edges_in_memory
+        num_edges_in_memory += 1
+        if options['edge_budget'] is not None and num_edges_in_memory >= options['edge_budget']:
+            spill_edges()
     else:
         loan_locs_from_lender[loan_loc]['lender_loan_count'] += 1
 
 
+def spill_edges():
+    global num_edges_in_memory
+    
+    edges = []
+    for lender_info in lender_locations.itervalues():
+        for loan_info in lender_info['loan_locations'].itervalues():
+            edges.append((lender_info['idx'], loan_info['idx'], loan_info['lender_loan_count']))
+        lender_info['loan_locations'] = {}
+    num_edges_in_memory = 0
+    
+    if len(edges) == 0:
+        return
+    
+    edges.sort()
+    write_edge_run(edges)
+
+
+def write_edge_run(edges):
+    path = os.path.join(EDGE_RUNS_DIR, 'run_{0}.bin'.format(len(edge_runs)))
+    file = open(path, 'wb')
+    for edge in edges:
+        file.write(EDGE_RECORD.pack(*edge))
+    file.close()
+    edge_runs.append(path)
+
+
+def read_edge_run(path):
+    file = open(path, 'rb')
+    while True:
+        data = file.read(EDGE_RECORD.size * EDGE_RECORDS_PER_READ)
+        if not data:
+            break
+        for offset in xrange(0, len(data), EDGE_RECORD.size):
+            yield EDGE_RECORD.unpack_from(data, offset)
+    file.close()
+
+
+def read_edges_csv(path):
+    file = open(path, 'r')
+    reader = csv.reader(file, delimiter=';')
+    reader.next()
+    for row in reader:
+        # The indices are mapped to the ones their points are stored with.
+        yield (idx_to_lender_map[int(row[0])]['idx'], idx_to_loan_map[int(row[1])]['idx'], int(row[2]))
+    file.close()
+
+
+def merge_edges(sources):
+    # The sources are each sorted, so matching lender-loans come out of the
+    # merge next to each other.
+    current = None
+    for lender_idx, loan_idx, count in heapq.merge(*sources):
+        if current is not None and current[0] == lender_idx and current[1] == loan_idx:
+            current[2] += count
+        else:
+            if current is not None:
+                yield current
+            current = [ lender_idx, loan_idx, count ]
+    if current is not None:
+        yield current
+
+
+def prepare_edge_runs():
+    global merge_existing_edges
+    
+    # Runs left behind by an interrupted execution belong to loans that were
+    # never recorded as processed, so they are discarded.
+    if not os.path.isdir(EDGE_RUNS_DIR):
+        os.mkdir(EDGE_RUNS_DIR)
+    for file_name in os.listdir(EDGE_RUNS_DIR):
+        os.remove(os.path.join(EDGE_RUNS_DIR, file_name))
+    
+    if not os.path.exists('lender_loans.csv'):
+        return
+    
+    # An existing lender_loans.csv can be merged as it is if it's sorted; otherwise
+    # (i.e. it was written without an edge budget) it is split into sorted runs.
+    prev_edge = None
+    merge_existing_edges = True
+    for edge in read_edges_csv('lender_loans.csv'):
+        if prev_edge is not None and edge[:2] <= prev_edge[:2]:
+            merge_existing_edges = False
+            break
+        prev_edge = edge
+    
+    if not merge_existing_edges:
+        print 'Splitting lender_loans.csv into sorted runs...'
+        edges = []
+        for edge in read_edges_csv('lender_loans.csv'):
+            edges.append(edge)
+            if len(edges) >= options['edge_budget']:
+                edges.sort()
+                write_edge_run(edges)
+                edges = []
+        if len(edges) > 0:
+            edges.sort()
+            write_edge_run(edges)
+
+
+def loan_bucket(loan):
+    for date_key in [ 'posted_date', 'funded_date' ]:
+        if loan.get(date_key):
+            return loan[date_key][:7]
+    return None
+
+
+def add_bucket_edge(bucket, lender_idx, loan_idx):
+    edges = bucket_edges.setdefault(bucket, {})
+    edge = (lender_idx, loan_idx)
+    edges[edge] = edges.get(edge, 0) + 1
+
+
+def write_buckets():
+    if not os.path.isdir(BUCKETS_DIR):
+        os.mkdir(BUCKETS_DIR)
+    
+    for bucket, edges in bucket_edges.iteritems():
+        bucket_info = bucket_index.setdefault(bucket, { 'num_records': 0, 'count': 0 })
+        
+        # Records past the ones in the index were written by an interrupted
+        # execution, and belong to loans that were never recorded as processed.
+        file = open(os.path.join(BUCKETS_DIR, '{0}.bin'.format(bucket)), 'ab')
+        file.truncate(bucket_info['num_records'] * EDGE_RECORD.size)
+        for edge in sorted(edges.iterkeys()):
+            file.write(EDGE_RECORD.pack(edge[0], edge[1], edges[edge]))
+        file.close()
+        
+        bucket_info['num_records'] += len(edges)
+        bucket_info['count'] += sum(edges.itervalues())
+    bucket_edges.clear()
+    
+    cumulative_count = 0
+    for bucket in sorted(bucket_index.iterkeys()):
+        cumulative_count += bucket_index[bucket]['count']
+        bucket_index[bucket]['cumulative_count'] = cumulative_count
+    
+    file = open(BUCKET_INDEX_PATH + '.tmp', 'wb')
+    file.write(json.dumps(bucket_index, sort_keys=True))
+    file.close()
+    os.rename(BUCKET_INDEX_PATH + '.tmp', BUCKET_INDEX_PATH)
+
+
+def memory_edges():
+    for lender_info in lender_locations.itervalues():
+        for loan_info in lender_info['loan_locations'].itervalues():
+            yield (lender_info['idx'], loan_info['idx'], loan_info['lender_loan_count'])
+
+
+def write_live_points(image):
+    # Writes the points added since the last image.
+    for kind, idx_to_map in [ (LENDER_POINTS, idx_to_lender_map), (LOAN_POINTS, idx_to_loan_map) ]:
+        points = []
+        for idx in xrange(live_state['points'][kind]['count'], len(idx_to_map)):
+            points.append((idx_to_map[idx]['lat'], idx_to_map[idx]['lon']))
+        write_image_points(image, kind, points)
+
+
+def commit_live_image(image):
+    global live_edges, last_live_publish
+    commit_image(image)
+    live_edges = {}
+    last_live_publish = time.time()
+
+
+def publish_live_state(sources = None):
+    # Publishes the lender-loans added since the last image on top of it, or, if the
+    # sources of all the lender-loans are given, all of them.
+    if sources is None:
+        image = begin_delta_image(live_state)
+        write_live_points(image)
+        write_image_edges(image, [ (lender_idx, loan_idx, count) for (lender_idx, loan_idx), count in live_edges.iteritems() ])
+    else:
+        image = begin_image(live_state)
+        write_live_points(image)
+        for edges in sources:
+            write_image_edges(image, edges)
+    commit_live_image(image)
+
+
+def loan_signature(loan):
+    return [ loan.get('status'), loan.get('funded_amount'), loan.get('lender_count') ]
+
+
+def lender_key(lender):
+    # Lenders without a uid (e.g. anonymous ones) are told apart by name and whereabouts.
+    if lender.get('uid'):
+        return lender['uid']
+    return u'{0}|{1}'.format(lender.get('name', ''), lender.get('whereabouts', ''))
+
+
+def uncounted_lenders(lenders, record):
+    # Returns the lenders that weren't counted when the loan was processed before, and adds
+    # them to the record. The keys are counted, since lenders without a uid can share one.
+    counted = {}
+    for key in record['lenders']:
+        counted[key] = counted.get(key, 0) + 1
+    
+    uncounted = []
+    for lender in lenders:
+        key = lender_key(lender)
+        if counted.get(key, 0) > 0:
+            counted[key] -= 1
+        else:
+            uncounted.append(lender)
+            record['lenders'].append(key)
+    return uncounted
+
+
+def finish_loan(loan_id, loan, record):
+    loan_ids[loan_id] = 1
+    if loan.get('status') == 'fundraising':
+        fundraising_loans[loan_id] = record
+    else:
+        fundraising_loans.pop(loan_id, None)
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    entry = snapshot_manifest['files'].get(path)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['hash']
+    
+    sha = hashlib.sha1()
+    file = open(path, 'rb')
+    while True:
+        data = file.read(HASH_BLOCK_BYTES)
+        if not data:
+            break
+        sha.update(data)
+    file.close()
+    
+    snapshot_manifest['files'][path] = { 'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': sha.hexdigest() }
+    return sha.hexdigest()
+
+
+def changed_loan_files():
+    # Returns the (path, hash) of every loan file in the snapshot that hasn't been processed,
+    # in order. Files that are no longer in the snapshot are dropped from the manifest.
+    file_names = [ name for name in os.listdir(LOANS_DIR) if name.endswith('.json') and name[:-5].isdigit() ]
+    file_paths = [ '{0}/{1}'.format(LOANS_DIR, name) for name in sorted(file_names, key=lambda name: int(name[:-5])) ]
+    
+    for path in snapshot_manifest['files'].keys():
+        if path not in file_paths:
+            del snapshot_manifest['files'][path]
+    
+    changed = []
+    for path in file_paths:
+        file_hash = file_fingerprint(path)
+        if file_hash not in snapshot_manifest['hashes']:
+            changed.append((path, file_hash))
+    return changed
+
+
+def loan_file_info(loan_data):
+    loan_id_list = [ loan['id'] for loan in loan_data['loans'] if 'id' in loan ]
+    return {
+        'num_loans': len(loan_id_list),
+        'min_id': min(loan_id_list) if loan_id_list else None,
+        'max_id': max(loan_id_list) if loan_id_list else None
+    }
+
+
 def add_lender_location_from_file(idx, lat, lon, count):
-    lender_loc = '{0} {1}'.format(lat, lon)
+    lender_loc = pack_point(lat, lon)
     if lender_loc not in lender_locations:
         lender_locations[lender_loc] = {
             'idx': idx,
@@ -170,11 +549,14 @@ def add_lender_location_from_file(idx, lat, lon, count):
             'lon': lon,
             'loan_locations': {}
         }
-        idx_to_lender_map[idx] = lender_locations[lender_loc]
+    else:
+        # Another row quantized to the same point, so its idx refers to that point.
+        lender_locations[lender_loc]['count'] += count
+    idx_to_lender_map[idx] = lender_locations[lender_loc]
 
 
 def add_loan_location_from_file(idx, lat, lon, count):
-    loan_loc = '{0} {1}'.format(lat, lon)
+    loan_loc = pack_point(lat, lon)
     if loan_loc not in loan_locations:
         loan_locations[loan_loc] = {
             'idx': idx,
@@ -182,7 +564,9 @@ def add_loan_location_from_file(idx, lat, lon, count):
             'lat': lat,
             'lon': lon
         }
-        idx_to_loan_map[idx] = loan_locations[loan_loc]
+    else:
+        loan_locations[loan_loc]['count'] += count
+    idx_to_loan_map[idx] = loan_locations[loan_loc]
 
 
 def add_lender_loan_from_file(lender_idx, loan_idx, lender_loan_count, distance):
@@ -190,16 +574,26 @@ def add_lender_loan_from_file(lender_idx, loan_idx, lender_loan_count, distance)
     loan_locs_from_lender = lender_info['loan_locations']
     
     loan_info = idx_to_loan_map[loan_idx]
-    loan_loc = '{0} {1}'.format(loan_info['lat'], loan_info['lon'])
+    loan_loc = pack_point(loan_info['lat'], loan_info['lon'])
     
     if loan_loc not in loan_locs_from_lender:
         loan_locs_from_lender[loan_loc] = {
-            'idx': loan_idx,
+            'idx': loan_info['idx'],
             'lender_loan_count': lender_loan_count,
-            'distance': distance,
+            'distance': float(distance),
             'lat': loan_info['lat'],
             'lon': loan_info['lon']
         }
+    else:
+        loan_locs_from_lender[loan_loc]['lender_loan_count'] += lender_loan_count
+
+
+def indexed_locations(idx_to_map):
+    # Yields (idx, info, count) in idx order. An idx which refers to another idx's point
+    # (see add_lender_location_from_file) is kept with a count of 0, so the indices stay dense.
+    for idx in xrange(len(idx_to_map)):
+        info = idx_to_map[idx]
+        yield idx, info, (info['count'] if info['idx'] == idx else 0)
 
 
 def unicode_csv_reader(utf8_data, delimiter=','):
@@ -215,7 +609,7 @@ def read_existing_data():
         reader = unicode_csv_reader(file, delimiter=';')
         reader.next()
         for row in reader:
-            add_lender_location_from_file(int(row[0]), row[1], row[2], int(row[3]))
+            add_lender_location_from_file(int(row[0]), to_fixed(row[1]), to_fixed(row[2]), int(row[3]))
         file.close()
     except IOError:
         # It had trouble opening the file, so it may not exist.
@@ -229,7 +623,7 @@ def read_existing_data():
         reader = unicode_csv_reader(file, delimiter=';')
         reader.next()
         for row in reader:
-            add_loan_location_from_file(int(row[0]), row[1], row[2], int(row[3]))
+            add_loan_location_from_file(int(row[0]), to_fixed(row[1]), to_fixed(row[2]), int(row[3]))
         file.close()
     except IOError:
         pass
@@ -237,23 +631,30 @@ def read_existing_data():
         log_exception('loan_locations.csv')
     
     # lender-loans
-    try:
-        file = open('lender_loans.csv', 'r')
-        reader = unicode_csv_reader(file, delimiter=';')
-        reader.next()
-        for row in reader:
-            add_lender_loan_from_file(int(row[0]), int(row[1]), int(row[2]), row[3])
-        file.close()
-    except IOError:
-        pass
-    except:
-        log_exception('lender_loans.csv')
+    if options['edge_budget'] is not None:
+        # These are merged from the file when they're written instead.
+        try:
+            prepare_edge_runs()
+        except:
+            log_exception('lender_loans.csv')
+    else:
+        try:
+            file = open('lender_loans.csv', 'r')
+            reader = unicode_csv_reader(file, delimiter=';')
+            reader.next()
+            for row in reader:
+                add_lender_loan_from_file(int(row[0]), int(row[1]), int(row[2]), row[3])
+            file.close()
+        except IOError:
+            pass
+        except:
+            log_exception('lender_loans.csv')
     
     # locations
     try:
         file = open('locations.json', 'r')
         global locations
-        locations = json.loads(file.read())
+        locations = migrate_locations(json.loads(file.read()))
         file.close()
     except IOError:
         pass
@@ -270,6 +671,38 @@ def read_existing_data():
         pass
     except:
         log_exception('load_ids.json')
+    
+    # time buckets
+    try:
+        file = open(BUCKET_INDEX_PATH, 'r')
+        global bucket_index
+        bucket_index = json.loads(file.read())
+        file.close()
+    except IOError:
+        pass
+    except:
+        log_exception(BUCKET_INDEX_PATH)
+    
+    # snapshot diffs
+    try:
+        file = open(FUNDRAISING_LOANS_PATH, 'r')
+        global fundraising_loans
+        fundraising_loans = json.loads(file.read())
+        file.close()
+    except IOError:
+        pass
+    except:
+        log_exception(FUNDRAISING_LOANS_PATH)
+    
+    try:
+        file = open(SNAPSHOT_MANIFEST_PATH, 'r')
+        global snapshot_manifest
+        snapshot_manifest = json.loads(file.read())
+        file.close()
+    except IOError:
+        pass
+    except:
+        log_exception(SNAPSHOT_MANIFEST_PATH)
 
 
 def read_loan_data(file_path):
@@ -288,13 +721,12 @@ def write_existing_data():
     file = open('lender_locations.csv', 'wb')
     writer = csv.writer(file, delimiter=';')
     writer.writerow(['idx', 'lat', 'lon', 'count'])
-    for loc, info in lender_locations.iteritems():
-        loc_split = loc.partition(' ')
+    for idx, info, count in indexed_locations(idx_to_lender_map):
         writer.writerow([
-            info['idx'],
-            loc_split[0],
-            loc_split[2],
-            info['count']
+            idx,
+            format_fixed(info['lat']),
+            format_fixed(info['lon']),
+            count
         ])
     file.close()
     
@@ -302,141 +734,272 @@ def write_existing_data():
     file = open('loan_locations.csv', 'wb')
     writer = csv.writer(file, delimiter=';')
     writer.writerow(['idx', 'lat', 'lon', 'count'])
-    for loc, info in loan_locations.iteritems():
-        loc_split = loc.partition(' ')
+    for idx, info, count in indexed_locations(idx_to_loan_map):
         writer.writerow([
-            info['idx'],
-            loc_split[0],
-            loc_split[2],
-            info['count']
+            idx,
+            format_fixed(info['lat']),
+            format_fixed(info['lon']),
+            count
         ])
     file.close()
     
     # lender-loans
+    if options['edge_budget'] is not None:
+        write_merged_edges()
+    else:
+        write_edges()
+    
+    # time buckets
+    write_buckets()
+    
+    # live state (with an edge budget, it's published as the lender-loans are merged)
+    if live_state is not None and options['edge_budget'] is None:
+        publish_live_state([ memory_edges() ])
+    
+    # locations
+    file = open('locations.json', 'wb')
+    file.write(json.dumps(locations))
+    file.close()
+    
+    # fundraising loans (written before the loan ids, so a loan is never recorded as processed
+    # with the lenders of an older snapshot)
+    file = open(FUNDRAISING_LOANS_PATH, 'wb')
+    file.write(json.dumps(fundraising_loans))
+    file.close()
+    
+    # loan ids
+    file = open('loan_ids.json', 'wb')
+    file.write(json.dumps(loan_ids))
+    file.close()
+    
+    # snapshot manifest (written last, so a file is only skipped once its loans are recorded)
+    file = open(SNAPSHOT_MANIFEST_PATH, 'wb')
+    file.write(json.dumps(snapshot_manifest))
+    file.close()
+
+
+def write_edges():
     file = open('lender_loans.csv', 'wb')
     writer = csv.writer(file, delimiter=';')
     writer.writerow(['lender_idx', 'loan_idx', 'count', 'distance', 'lender_lat', 'lender_lon', 'loan_lat', 'loan_lon'])
-    for lender_loc, lender_info in lender_locations.iteritems():
-        lender_loc_split = lender_loc.partition(' ')
-        for loan_loc, loan_info in lender_info['loan_locations'].iteritems():
-            loan_loc_split = loan_loc.partition(' ')
+    for lender_info in lender_locations.itervalues():
+        for loan_info in lender_info['loan_locations'].itervalues():
             writer.writerow([
                 lender_info['idx'],
                 loan_info['idx'],
                 loan_info['lender_loan_count'],
                 loan_info['distance'],
-                lender_loc_split[0],
-                lender_loc_split[2],
-                loan_loc_split[0],
-                loan_loc_split[2]
+                format_fixed(lender_info['lat']),
+                format_fixed(lender_info['lon']),
+                format_fixed(loan_info['lat']),
+                format_fixed(loan_info['lon'])
             ])
     file.close()
+
+
+def stored_edge_sources():
+    # With an edge budget, the sorted sources of the lender-loans that aren't in memory.
+    sources = [ read_edge_run(path) for path in edge_runs ]
+    if merge_existing_edges:
+        sources.append(read_edges_csv('lender_loans.csv'))
+    return sources
+
+
+def write_merged_edges():
+    global edge_runs, merge_existing_edges
     
-    # locations
-    file = open('locations.json', 'wb')
-    file.write(json.dumps(locations))
+    spill_edges()
+    merged_edges = merge_edges(stored_edge_sources())
+    if live_state is not None:
+        image = begin_image(live_state)
+        write_live_points(image)
+        merged_edges = tee_image_edges(image, merged_edges)
+    
+    file = open('lender_loans.csv.tmp', 'wb')
+    writer = csv.writer(file, delimiter=';')
+    writer.writerow(['lender_idx', 'loan_idx', 'count', 'distance', 'lender_lat', 'lender_lon', 'loan_lat', 'loan_lon'])
+    for lender_idx, loan_idx, count in merged_edges:
+        lender_info = idx_to_lender_map[lender_idx]
+        loan_info = idx_to_loan_map[loan_idx]
+        writer.writerow([
+            lender_idx,
+            loan_idx,
+            count,
+            distance_between(lender_info, loan_info),
+            format_fixed(lender_info['lat']),
+            format_fixed(lender_info['lon']),
+            format_fixed(loan_info['lat']),
+            format_fixed(loan_info['lon'])
+        ])
     file.close()
+    os.rename('lender_loans.csv.tmp', 'lender_loans.csv')
     
-    # loan ids
-    file = open('loan_ids.json', 'wb')
-    file.write(json.dumps(loan_ids))
+    if live_state is not None:
+        commit_live_image(image)
+    
+    # The runs are now part of lender_loans.csv.
+    for path in edge_runs:
+        os.remove(path)
+    edge_runs = []
+    merge_existing_edges = True
+
+
+def read_edge_rows(path):
+    file = open(path, 'r')
+    reader = csv.reader(file, delimiter=';')
+    reader.next()
+    for row in reader:
+        yield row
+    file.close()
+
+
+def edge_sort_value(distance, count, max_distance, max_count):
+    # The same as the sortValue of kiva.R.
+    range_len = max_distance / DISTANCE_RANGE_NUM
+    if range_len == 0:
+        return count
+    return int(floor((max_distance - distance) / range_len)) * max_count + count
+
+
+def write_top_edges():
+    # The sortValue of a lender-loan depends on the max distance and count of all of
+    # them, so lender_loans.csv is scanned once for those, and once more keeping the
+    # lender-loans with the highest sortValue in a heap of at most [max_edges].
+    if not os.path.exists('lender_loans.csv'):
+        return
+    
+    max_distance = 0
+    max_count = 0
+    for row in read_edge_rows('lender_loans.csv'):
+        max_distance = max(max_distance, float(row[3]))
+        max_count = max(max_count, int(row[2]))
+    
+    top_edges = []
+    for i, row in enumerate(read_edge_rows('lender_loans.csv')):
+        edge = (edge_sort_value(float(row[3]), int(row[2]), max_distance, max_count), i, row)
+        if len(top_edges) < options['max_edges']:
+            heapq.heappush(top_edges, edge)
+        elif edge > top_edges[0]:
+            heapq.heapreplace(top_edges, edge)
+    top_edges.sort()
+    
+    file = open(TOP_EDGES_PATH + '.tmp', 'wb')
+    writer = csv.writer(file, delimiter=';')
+    writer.writerow(['lender_idx', 'loan_idx', 'count', 'distance', 'lender_lat', 'lender_lon', 'loan_lat', 'loan_lon', 'sort_value'])
+    for sort_value, i, row in top_edges:
+        writer.writerow(row + [ sort_value ])
     file.close()
+    os.rename(TOP_EDGES_PATH + '.tmp', TOP_EDGES_PATH)
 
 
 def process_loan_data(loan_data):
     # Iterate through each loan until we've processed all the loans or
-    # we've reached the user-supplied max:
+    # we've reached the user-supplied max. Returns the number of loans
+    # processed, and whether every loan was.
     global loan_ids
     num_loans_processed = 0
+    complete = True
     stop = 0
     for loan in loan_data['loans']:
+        if live_state is not None and len(live_edges) > 0 and time.time() - last_live_publish >= LIVE_PUBLISH_SECONDS:
+            publish_live_state()
+        
+        # With --delta, files are only skipped once all their loans are processed, so
+        # they're always processed in full.
         stop += 1
-        if stop == 30:
+        if stop == 30 and not options['delta']:
+            complete = False
             break
         
         # Ignore incomplete loan data.
         if 'id' not in loan or 'location' not in loan:
             continue
         
-        # Ignore repeated loans.
+        # Ignore repeated loans, unless they were fundraising and have changed since.
         loan_id = str(loan['id'])
+        prev_record = None
         if loan_id in loan_ids:
-            continue
+            prev_record = fundraising_loans.get(loan_id)
+            if prev_record is None or prev_record['signature'] == loan_signature(loan):
+                continue
+        
+        if prev_record is None:
+            record = { 'signature': loan_signature(loan), 'lenders': [], 'located': False }
+        else:
+            record = dict(prev_record, signature=loan_signature(loan), lenders=list(prev_record['lenders']))
         
         try:
-            time.sleep(SECONDS_BETWEEN_KIVA_QUERIES)
-            
             # Fetch the lenders for this loan from Kiva.
             print u'{0}) Fetching lenders from kiva for loan with id "{1}".'.format(num_loans_processed + 1, loan_id)
-            lenders_url = urllib.urlopen('http://api.kivaws.org/v1/loans/{0}/lenders.json'.format(loan_id))
-            lenders_data = json.loads(lenders_url.read())
+            lenders_data = json.loads(fetch('kiva', 'http://api.kivaws.org/v1/loans/{0}/lenders.json'.format(loan_id)))
             
             # Ignore loans without any returned lenders.
             if not lenders_data['lenders']:
-                loan_ids[loan_id] = 1
+                finish_loan(loan_id, loan, record)
                 num_loans_processed += 1
                 print '   (this loan had no lenders)'.format(loan_id)
-                log_warning(u'Loan with id {0} did not have any lenders'.format(loan_id), lenders_data)
+                log_warning(u'Loan with id {0} did not have any lenders'.format(loan_id), lenders_data, 'no_lenders')
                 continue
             
+            # A changed loan only adds the lenders it has gained.
+            lenders = uncounted_lenders(lenders_data['lenders'], record)
+            if prev_record is not None:
+                print '   (this loan has changed; {0} new lender(s))'.format(len(lenders))
+            
             # Ignore loans without any valid lenders.
             has_valid_lenders = False
-            for lender in lenders_data['lenders']:
+            for lender in lenders:
                 if 'whereabouts' in lender:
                     has_valid_lenders = True
                     break
             if not has_valid_lenders:
-                loan_ids[loan_id] = 1
+                finish_loan(loan_id, loan, record)
                 num_loans_processed += 1
-                print '   (this loan had no valid lenders)'.format(loan_id)
-                log_warning(u'Loan with id {0} did not have any valid lenders'.format(loan_id), lenders_data)
+                if prev_record is None:
+                    print '   (this loan had no valid lenders)'.format(loan_id)
+                    log_warning(u'Loan with id {0} did not have any valid lenders'.format(loan_id), lenders_data, 'no_valid_lenders')
                 continue
             
             # Get the lat/lon pair for this loan.
-            loan_loc = loan['location']['geo']['pairs']
-            loan_loc_split = loan_loc.partition(' ')
-            add_loan_location(loan_loc_split[0], loan_loc_split[2])
+            loan_loc = parse_point(loan['location']['geo']['pairs'])
+            if not record['located']:
+                add_loan_location(loan_loc)
+                record['located'] = True
+            bucket = loan_bucket(loan)
             
             # Iterate through each lender:
             num_lenders_processed = 0
-            for lender in lenders_data['lenders']:
+            for lender in lenders:
                 # Ignore incomplete lender data.
                 if 'whereabouts' not in lender:
                     continue
                 
-                loc_str = lender['whereabouts'].lower()
-                if 'country_code' in lender:
-                    loc_str += ', ' + lender['country_code'].upper()
-                
-                # Remove some URLs commonly found in location data.
-                loc_str = loc_str.replace('http://www.kivafriends.org', '')
-                loc_str = loc_str.replace('http://kivafriends.org', '')
-                loc_str = loc_str.replace('www.kivafriends.org', '')
-                loc_str = loc_str.replace('kivafriends.org', '')
+                loc_str = normalize_location(lender['whereabouts'], lender.get('country_code'))
                 
                 if loc_str not in locations:
-                    time.sleep(SECONDS_BETWEEN_GMAPS_QUERIES)
-                    
                     try:
-                        # Fetch the lender's location from Google Maps.
+                        # Look up the lender's location with the geocoders.
                         try:
-                            print u'\t-> Fetching lender location "{0}" from gmaps'.format(loc_str)
+                            print u'\t-> Looking up lender location "{0}"'.format(loc_str)
                         except UnicodeEncodeError:
-                            print '\t-> Fetching lender location (cannot be displayed) from gmaps'
-                        locUrl = urllib.urlopen(u'http://maps.googleapis.com/maps/geo?q={0}'.format(loc_str).encode('utf-8'))
-                        locData = json.loads(locUrl.read())
-                        if 'Placemark' not in locData:
-                            # The address was not found by Google Maps, so save it as invalid and add a warning.
+                            print '\t-> Looking up lender location (cannot be displayed)'
+                        point = geocode(loc_str)
+                        if point == NOT_FOUND:
+                            # The address doesn't exist according to a remote geocoder, so save it as invalid and add a warning.
                             locations[loc_str] = -1
-                            log_warning(u'Marked lender location "{0}" as invalid'.format(loc_str), locData)
+                            log_warning(u'Marked lender location "{0}" as invalid'.format(loc_str), category='invalid_location')
+                            continue
+                        elif point is None:
+                            # The address couldn't be resolved (e.g. it's not in the gazetteer and no remote
+                            # geocoder is used), so it isn't saved, and is looked up again next time.
+                            log_warning(u'Could not resolve lender location "{0}"'.format(loc_str), category='unresolved_location')
                             continue
                         
-                        coords = locData['Placemark'][0]['Point']['coordinates']
-                        add_lender_location(loc_str, str(coords[1]), str(coords[0]))
+                        add_lender_location(loc_str, to_fixed(point[0]), to_fixed(point[1]))
                     except KeyboardInterrupt:
                         raise
                     except StandardError:
-                        log_exception('lender', lender)
+                        log_exception('lender', lender, 'lender')
                         continue
                 
                 if locations[loc_str] == -1:
@@ -444,26 +1007,57 @@ def process_loan_data(loan_data):
                 
                 # Store the loan location within each lender location.
                 add_lender_loan(locations[loc_str], loan_loc)
+                if bucket is not None:
+                    add_bucket_edge(bucket, locations[loc_str], loan_locations[loan_loc]['idx'])
                 num_lenders_processed += 1
             
             # If no lenders are processed, it might be the result of a bug, so it's logged for further evaluation.
-            if num_lenders_processed == 0:
-                log_warning('No lenders were processed for loan with id: ' + loan_id, lenders_data)
+            if num_lenders_processed == 0 and prev_record is None:
+                log_warning('No lenders were processed for loan with id: ' + loan_id, lenders_data, 'no_lenders_processed')
             
             # Store the newly processed loan id and increment the loan count.
-            loan_ids[loan_id] = 1
+            finish_loan(loan_id, loan, record)
             num_loans_processed += 1
         except KeyboardInterrupt:
             raise
         except:
-            log_exception('loan', loan)
+            log_exception('loan', loan, 'loan')
+            complete = False
     
+    return num_loans_processed, complete
+
+
+def process_loan_file(file_path, file_hash = None):
+    # Returns the number of loans processed, or None if the file couldn't be read. With
+    # --delta, the file's hash is given, and it's recorded once all its loans are processed.
+    print 'Processing loans from {0}'.format(file_path)
+    loan_data = read_loan_data(file_path)
+    if loan_data is None:
+        return None
+    
+    num_loans_processed, complete = process_loan_data(loan_data)
+    file_info = loan_file_info(loan_data)
+    if file_hash is not None and complete:
+        snapshot_manifest['hashes'][file_hash] = file_info
+    print 'Processed {0} loans from {1} (loan ids {2} to {3})'.format(num_loans_processed, file_path, file_info['min_id'], file_info['max_id'])
     return num_loans_processed
 
 
 def validate_args(args):
     try:
         if len(args) >= 2 and int(args[1]) > 0:
+            for arg in args[2:]:
+                name, sep, value = arg.partition('=')
+                if name == '--edge-budget' and int(value) > 0:
+                    options['edge_budget'] = int(value)
+                elif name == '--max-edges' and int(value) > 0:
+                    options['max_edges'] = int(value)
+                elif name == '--delta' and sep == '':
+                    options['delta'] = True
+                elif name == '--live' and sep == '':
+                    options['live'] = True
+                else:
+                    return False
             return True
     except ValueError:
         pass
@@ -471,14 +1065,15 @@ def validate_args(args):
 
 
 def main(*args):
+    global live_state
     if validate_args(args) == False:
-        print 'Usage: ' + args[0] + ' <number of loan files>'
+        print 'Usage: ' + args[0] + ' <number of loan files> [--edge-budget=<number of edges>] [--max-edges=<number of edges>] [--delta] [--live]'
         return 0
     
     # Initialize variables used for exceptions.
     log_exception.num_errors_logged = 0
     log_warning.num_warnings_logged = 0
-    log_exception.log_file = open('process_loans_log.txt', 'wb', 0)
+    open_log('process_loans_log.txt')
     
     # Get the number of loan files to process from the user.
     numLoanFilesToProcess = int(args[1])
@@ -487,29 +1082,63 @@ def main(*args):
     
     # Start from where we left off; read in the existing loan data.
     print 'Reading in existing loan data...'
+    load_aliases()
     read_existing_data()
     
-    print 'Starting to process {0} loan files...'.format(numLoanFilesToProcess)
-    while loanFilesProcessed < numLoanFilesToProcess:
-        # Read in the loan data.
-        file_path = 'loans/{0}.json'.format(loan_ids['file_num'])
-        print 'Processing loans from {0}'.format(file_path)
-        loan_data = read_loan_data(file_path)
-        if loan_data is None:
-            print 'Could not open {0}, exiting the script.'.format(file_path)
-            return 0
-        
-        # Process the loan data and write the results to the files.
-        num_loans_processed = process_loan_data(loan_data)
-        total_loans_processed += num_loans_processed
-        
-        print 'Processed {0} loans from {1}'.format(num_loans_processed, file_path)
-        loan_ids['file_num'] += 1
-        write_existing_data()
-        if num_loans_processed > 0:
-            loanFilesProcessed += 1
+    if options['live']:
+        print 'Publishing the existing data to {0}...'.format(LIVE_STATE_PATH)
+        live_state = open_live_state(LIVE_STATE_PATH)
+        if options['edge_budget'] is not None:
+            publish_live_state(stored_edge_sources())
+        else:
+            publish_live_state([ memory_edges() ])
+    
+    if options['delta']:
+        # Only the files that weren't in the snapshots processed before are read.
+        print 'Finding the loan files that are new or changed since the last snapshot...'
+        loan_files = changed_loan_files()
+        print 'Starting to process {0} of {1} new or changed loan files...'.format(min(numLoanFilesToProcess, len(loan_files)), len(loan_files))
+        for file_path, file_hash in loan_files:
+            if loanFilesProcessed >= numLoanFilesToProcess:
+                break
+            
+            num_loans_processed = process_loan_file(file_path, file_hash)
+            if num_loans_processed is None:
+                print 'Could not open {0}, skipping it.'.format(file_path)
+                continue
+            
+            # A file read again only for its loans that failed before doesn't count.
+            total_loans_processed += num_loans_processed
+            write_existing_data()
+            if num_loans_processed > 0:
+                loanFilesProcessed += 1
+    else:
+        print 'Starting to process {0} loan files...'.format(numLoanFilesToProcess)
+        while loanFilesProcessed < numLoanFilesToProcess:
+            # Process the loan data and write the results to the files.
+            file_path = '{0}/{1}.json'.format(LOANS_DIR, loan_ids['file_num'])
+            num_loans_processed = process_loan_file(file_path)
+            if num_loans_processed is None:
+                print 'Could not open {0}, stopping.'.format(file_path)
+                break
+            total_loans_processed += num_loans_processed
+            
+            loan_ids['file_num'] += 1
+            write_existing_data()
+            if num_loans_processed > 0:
+                loanFilesProcessed += 1
+    
+    # The top lender-loans are only needed for drawing, so they're written once at the end
+    # (and removed if they weren't asked for, so kiva.R doesn't draw stale ones).
+    if options['max_edges'] is not None:
+        print 'Writing the top {0} lender-loans to {1}...'.format(options['max_edges'], TOP_EDGES_PATH)
+        write_top_edges()
+    elif os.path.exists(TOP_EDGES_PATH):
+        os.remove(TOP_EDGES_PATH)
     
-    log_exception.log_file.close()
+    if live_state is not None:
+        close_live_state(live_state)
+    close_log()
     print 'Finished processing {0} loans in {1} loan files.'.format(total_loans_processed, loanFilesProcessed)
     print 'There were {0} error(s) and {1} warning(s) logged.'.format(log_exception.num_errors_logged, log_warning.num_warnings_logged)
 
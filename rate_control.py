@@ -0,0 +1,132 @@
+import  urllib2, httplib, socket, time, random
+
+#####################################################################
+#
+#  This module makes the HTTP requests of process_loans.py,
+#  generate_custom_map.py and geocoders.py, pacing the requests to
+#  each service (e.g. 'kiva') with a controller of its own.
+#
+#  Every controller paces its requests at a rate (requests/second)
+#  that is adjusted additive-increase/multiplicative-decrease:
+#   - every successful request raises it by [RATE_INCREASE], up to
+#     [MAX_RATE]
+#   - every request that is rate limited (429) or fails on the
+#     server (5xx) halves it, down to [MIN_RATE], and honors the
+#     Retry-After header if there is one
+#  so it settles just under the highest rate the service allows.
+#
+#  Failed requests (the errors above, or connection errors) are
+#  retried after a jittered exponential backoff. After
+#  [MAX_RETRIES] failures in a row the circuit breaker opens: the
+#  controller pauses for [BREAKER_PAUSE_SECONDS] (doubling on every
+#  pause in a row, up to [MAX_BREAKER_PAUSE_SECONDS]) and then tries
+#  again. A request that is still failing after
+#  [MAX_BREAKER_PAUSES_PER_REQUEST] pauses raises its last error, so
+#  that the caller can skip it. Other HTTP errors (e.g. 404) aren't
+#  retried; their response is returned as it is, for the caller to
+#  handle.
+#
+#####################################################################
+
+
+INITIAL_RATE = 1.0
+MIN_RATE = 0.05
+MAX_RATE = 10.0
+RATE_INCREASE = 0.05
+RATE_DECREASE_FACTOR = 0.5
+MAX_RETRIES = 5
+RETRY_BASE_SECONDS = 1
+MAX_RETRY_SECONDS = 60
+BREAKER_PAUSE_SECONDS = 60
+MAX_BREAKER_PAUSE_SECONDS = 30 * 60
+MAX_BREAKER_PAUSES_PER_REQUEST = 3
+REQUEST_TIMEOUT_SECONDS = 60
+
+# [controllers] is a map of service name -> controller: its rate, the time
+# of its next request, the number of failures in a row, and the length of
+# its next circuit breaker pause.
+controllers = {}
+
+
+def get_controller(name):
+    if name not in controllers:
+        controllers[name] = {
+            'rate': INITIAL_RATE,
+            'next_time': 0,
+            'num_failures': 0,
+            'breaker_pause': BREAKER_PAUSE_SECONDS
+        }
+    return controllers[name]
+
+
+def wait_turn(controller):
+    now = time.time()
+    if controller['next_time'] > now:
+        time.sleep(controller['next_time'] - now)
+        now = controller['next_time']
+    controller['next_time'] = now + 1.0 / controller['rate']
+
+
+def on_success(controller):
+    controller['rate'] = min(MAX_RATE, controller['rate'] + RATE_INCREASE)
+    controller['num_failures'] = 0
+    controller['breaker_pause'] = BREAKER_PAUSE_SECONDS
+
+
+def on_failure(name, controller, slow_down, retry_after = None):
+    # Waits out the backoff (or circuit breaker pause) before the request is
+    # retried. Returns whether the circuit breaker opened.
+    if slow_down:
+        controller['rate'] = max(MIN_RATE, controller['rate'] * RATE_DECREASE_FACTOR)
+    controller['num_failures'] += 1
+
+    if controller['num_failures'] >= MAX_RETRIES:
+        print u'   ({0} failed {1} times in a row; pausing for {2} seconds)'.format(name, controller['num_failures'], controller['breaker_pause'])
+        time.sleep(controller['breaker_pause'])
+        controller['breaker_pause'] = min(MAX_BREAKER_PAUSE_SECONDS, controller['breaker_pause'] * 2)
+        controller['num_failures'] = 0
+        return True
+
+    backoff = random.uniform(0, min(MAX_RETRY_SECONDS, RETRY_BASE_SECONDS * 2 ** controller['num_failures']))
+    if retry_after is not None:
+        backoff = max(backoff, retry_after)
+    time.sleep(backoff)
+    return False
+
+
+def read_retry_after(error):
+    try:
+        return float(error.info().getheader('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch(name, url):
+    # Returns the body of the response to the url, retrying until there is one,
+    # or raises the last error once the circuit breaker has opened
+    # [MAX_BREAKER_PAUSES_PER_REQUEST] times for it.
+    controller = get_controller(name)
+    num_breaker_pauses = 0
+    while True:
+        wait_turn(controller)
+        try:
+            stream = urllib2.urlopen(url, timeout=REQUEST_TIMEOUT_SECONDS)
+            data_str = stream.read()
+            stream.close()
+        except urllib2.HTTPError, e:
+            if e.code != 429 and e.code < 500:
+                return e.read()
+            if on_failure(name, controller, True, read_retry_after(e)):
+                num_breaker_pauses += 1
+                if num_breaker_pauses >= MAX_BREAKER_PAUSES_PER_REQUEST:
+                    raise
+            continue
+        except (urllib2.URLError, httplib.HTTPException, socket.error):
+            if on_failure(name, controller, False):
+                num_breaker_pauses += 1
+                if num_breaker_pauses >= MAX_BREAKER_PAUSES_PER_REQUEST:
+                    raise
+            continue
+
+        on_success(controller)
+        return data_str
@@ -0,0 +1,64 @@
+import  os, sys, json, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import  process_loans
+
+
+LOANS_PER_FILE = 40
+
+
+def loan(loan_id):
+    return {
+        'id': loan_id,
+        'location': { 'geo': { 'pairs': '{0} {1}'.format(loan_id % 10, loan_id % 20) } },
+        'status': 'funded',
+        'funded_amount': 25,
+        'lender_count': 1
+    }
+
+
+def fetch(name, url):
+    # Every loan has one lender, at a location named after the loan.
+    loan_id = url.split('/')[-2]
+    return json.dumps({ 'lenders': [ { 'uid': 'u' + loan_id, 'whereabouts': 'place ' + loan_id[-1], 'country_code': 'US' } ] })
+
+
+class DeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.mkdir(process_loans.LOANS_DIR)
+        for file_num in xrange(1, 4):
+            loan_ids = xrange(file_num * 100, file_num * 100 + LOANS_PER_FILE)
+            file = open('{0}/{1}.json'.format(process_loans.LOANS_DIR, file_num), 'w')
+            file.write(json.dumps({ 'loans': [ loan(loan_id) for loan_id in loan_ids ] }))
+            file.close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def run_delta(self, num_files):
+        # Every execution of the script starts with fresh globals.
+        module = reload(process_loans)
+        module.fetch = fetch
+        module.geocode = lambda loc_str: (float(loc_str.split(u',')[0][-1]), 0.0)
+        module.main('process_loans.py', str(num_files), '--delta')
+        return module
+
+    def test_completed_files_are_skipped(self):
+        module = self.run_delta(2)
+        self.assertEqual(len(module.snapshot_manifest['hashes']), 2)
+        self.assertEqual(len(module.loan_ids) - 1, 2 * LOANS_PER_FILE)
+
+        # The second execution only has the third file left.
+        module = self.run_delta(2)
+        self.assertEqual(module.changed_loan_files(), [])
+        self.assertEqual(len(module.snapshot_manifest['hashes']), 3)
+        self.assertEqual(len(module.loan_ids) - 1, 3 * LOANS_PER_FILE)
+
+
+if __name__ == '__main__':
+    unittest.main()
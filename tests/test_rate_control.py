@@ -0,0 +1,37 @@
+import  os, sys, socket, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import  rate_control
+
+
+class FetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.num_requests = 0
+        self.slept = []
+        self.urlopen = rate_control.urllib2.urlopen
+        self.sleep = rate_control.time.sleep
+        rate_control.urllib2.urlopen = self.failing_urlopen
+        rate_control.time.sleep = self.slept.append
+        rate_control.controllers.clear()
+
+    def tearDown(self):
+        rate_control.urllib2.urlopen = self.urlopen
+        rate_control.time.sleep = self.sleep
+        rate_control.controllers.clear()
+
+    def failing_urlopen(self, url, timeout):
+        self.num_requests += 1
+        raise socket.error('connection refused')
+
+    def test_request_that_keeps_failing_raises(self):
+        self.assertRaises(socket.error, rate_control.fetch, 'test', 'http://example.com/')
+        self.assertEqual(self.num_requests, rate_control.MAX_RETRIES * rate_control.MAX_BREAKER_PAUSES_PER_REQUEST)
+
+        # The service is still paced as before for the next request.
+        controller = rate_control.get_controller('test')
+        self.assertEqual(controller['breaker_pause'], rate_control.BREAKER_PAUSE_SECONDS * 2 ** rate_control.MAX_BREAKER_PAUSES_PER_REQUEST)
+
+
+if __name__ == '__main__':
+    unittest.main()